@@ -28,10 +28,10 @@ class NetworkActivityLayer(nn.Module):
         # Create sparse weight mask according to relationships
         mask = torch.zeros((input_size, output_size), device=self.device)
 
-        # Set to 1 where there is a relation
-        for i in range(input_size):
-            for latent_idx in relation_dict.get(i, []):
-                mask[i, latent_idx] = 1
+        # Set to 1 where there is a relation (single scatter over the edge list)
+        rows = [i for i, latents in relation_dict.items() if i < input_size for _ in latents]
+        cols = [j for i, latents in relation_dict.items() if i < input_size for j in latents]
+        mask[torch.tensor(rows, dtype=torch.long), torch.tensor(cols, dtype=torch.long)] = 1
 
         # Include lambda parameter
         self.mask = mask
@@ -152,6 +152,8 @@ class Evaluator:
 
         for epoch in tqdm(range(self.epochs), desc = 'Training'):
             self.model.train()
+            report = epoch % self.report_epoch == 0
+            # batch losses stay on the device; they are read back once, on report epochs
             epoch_losses = []
 
             for batch in train_loader:
@@ -161,14 +163,15 @@ class Evaluator:
                 loss = self.compute_loss(batch, output)
                 loss.backward()
                 self.optimizer.step()
-                epoch_losses.append(loss.item())
+                if report:
+                    epoch_losses.append(loss.detach())
 
             # Evaluation and metrics
-            if epoch % self.report_epoch == 0:
+            if report:
                 metrics = self.evaluate(test_data)
                 metrics.update({
                     'epoch': epoch,
-                    'train_loss': np.mean(epoch_losses),
+                    'train_loss': np.mean(torch.stack(epoch_losses).tolist()),
                     'encoder_name': self.encoder_name,
                     'mode': self.mode
                 })
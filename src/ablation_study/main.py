@@ -5,9 +5,10 @@ from typing import List
 import pandas as pd
 import torch
 from sklearn.model_selection import train_test_split
-from torch.utils.data import DataLoader
+import numpy as np
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler
 from evaluator import Evaluator, SenaModel, MLPModel
-from utils import Norman2019DataLoader
+from utils import DenseRows, Norman2019DataLoader
 import logging
 
 def main():
@@ -26,6 +27,7 @@ def main():
     parser.add_argument("--lambda_sena", type=float, default=0, help="Sena λ value")
     parser.add_argument("--lambda_l1", type=float, default=1e-5, help="L1 λ value")
     parser.add_argument("--epochs", type=int, default=250, help="Epochs")
+    parser.add_argument("--backed", action="store_true", help="Keep the expression matrix on disk and read batches from it")
     args = parser.parse_args()
     logging.info(f"Parsed arguments: {args}")
 
@@ -43,7 +45,7 @@ def main():
     # Load data
     logging.info(f"Loading dataset: {args.dataset}")
     if "Norman" in args.dataset:
-        data_handler = Norman2019DataLoader(dataname=args.dataset)
+        data_handler = Norman2019DataLoader(dataname=args.dataset, backed=args.backed)
         data_handler.load_norman_2019_dataset()
         logging.info(
             f"Data loaded: {data_handler.adata.shape[0]} samples, {data_handler.adata.shape[1]} features."
@@ -58,13 +60,17 @@ def main():
     for seed in range(args.nseeds):
         logging.info(f"Running evaluation for seed {seed}")
 
-        # Split data into training and testing sets
-        train_data, test_data = train_test_split(
-            torch.tensor(data_handler.adata.X.todense()).float(),
+        # Split cell indices into training and testing sets; cells are densified
+        # per batch, and only the test set is densified as a whole
+        train_idx, test_idx = train_test_split(
+            np.arange(data_handler.adata.shape[0]),
             stratify=data_handler.adata.obs["guide_ids"],
             test_size=0.1,
             random_state=seed,
         )
+        rows = data_handler.single_rows
+        train_data = DenseRows(data_handler.X, rows[train_idx])
+        test_data = DenseRows(data_handler.X, rows[test_idx])[np.arange(len(test_idx))]
         logging.info(
             f"Split data: {len(train_data)} training samples, {len(test_data)} testing samples."
         )
@@ -106,7 +112,9 @@ def main():
         # Run evaluation
         logging.info(f"Starting evaluation for seed {seed}")
         train_loader = DataLoader(
-            train_data, batch_size=args.batch_size, shuffle=True
+            train_data,
+            sampler=BatchSampler(RandomSampler(train_data), args.batch_size, drop_last=False),
+            batch_size=None,
         )
         results_df = evaluator.run(
             model=model,
@@ -1,5 +1,6 @@
 import pickle
 import numpy as np
+import scipy.sparse as sp
 import torch
 from torch.utils.data import Dataset
 import scanpy as sc
@@ -27,12 +28,15 @@ from collections import Counter
 
 class Norman2019DataLoader:
     def __init__(
-        self, num_gene_th=5, dataname="Norman2019_raw"
+        self, num_gene_th=5, dataname="Norman2019_raw", backed=False
     ):
         self.num_gene_th = num_gene_th
+        self.backed = backed
         self.datafile = os.path.join('data',f"{dataname}.h5ad")
 
         # Initialize variables
+        self.X = None
+        self.single_rows = None
         self.adata = None
         self.double_adata = None
         self.ptb_targets = None
@@ -49,9 +53,10 @@ class Norman2019DataLoader:
         # Define file path
         fpath = self.datafile
 
-        # Keep only single interventions
-        adata = sc.read_h5ad(fpath)
-        adata = adata[(~adata.obs["guide_ids"].str.contains(","))]
+        # Keep only single interventions (X stays on disk if backed)
+        adata_full = sc.read_h5ad(fpath, backed="r" if self.backed else None)
+        single = ~adata_full.obs["guide_ids"].str.contains(",")
+        adata = adata_full[single]
 
         # Build gene sets
         gos, GO_to_ensembl_id_assignment, gene_go_dict = self.load_gene_go_assignments(
@@ -70,17 +75,18 @@ class Norman2019DataLoader:
 
         # Load double perturbation data
         ptb_targets = sorted(adata.obs["guide_ids"].unique().tolist())[1:]
-        double_adata = sc.read_h5ad(fpath).copy()
-        double_adata = double_adata[
-            (double_adata.obs["guide_ids"].str.contains(","))
+        double_adata = adata_full[
+            (adata_full.obs["guide_ids"].str.contains(","))
             & (
-                double_adata.obs["guide_ids"].map(
+                adata_full.obs["guide_ids"].map(
                     lambda x: all([y in ptb_targets for y in x.split(",")])
                 )
             )
         ]
 
         # Assign instance variables
+        self.X = adata_full.X
+        self.single_rows = np.flatnonzero(single)
         self.adata = adata
         self.double_adata = double_adata
         self.ptb_targets = ptb_targets
@@ -185,6 +191,28 @@ class Norman2019DataLoader:
         return rel_dict
 
 """tools"""
+class DenseRows(Dataset):
+    """
+    Rows of a (possibly sparse, or backed on disk) matrix X, densified one
+    batch at a time so that X is never densified as a whole. Items are lists
+    of positions into rows, as yielded by a BatchSampler.
+    """
+
+    def __init__(self, X, rows):
+        self.X = X
+        self.rows = np.asarray(rows)
+
+    def __getitem__(self, item):
+        # backed reads need increasing, unique row indices
+        rows, inverse = np.unique(self.rows[item], return_inverse=True)
+        X = self.X[rows]
+        X = X.toarray() if sp.issparse(X) else np.asarray(X)
+        return torch.from_numpy(X[inverse]).float()
+
+    def __len__(self):
+        return len(self.rows)
+
+
 def build_activity_score_df(model, adata, ptb_targets):
 
     na_activity_score = {}
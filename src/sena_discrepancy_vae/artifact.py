@@ -0,0 +1,162 @@
+import json
+import os
+import struct
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import torch
+from model import CMVAE, cmvae_from_config, relation_edges
+
+# bump when the layout of model artifacts changes
+ARTIFACT_VERSION = 1
+
+CONFIG_FILE = "config.json"
+TENSOR_FILE = "tensors.bin"
+
+# tensor data offsets are aligned so that every tensor can be viewed in place
+ALIGNMENT = 64
+
+TENSOR_DTYPES = {
+    "float64": torch.float64,
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "int64": torch.int64,
+    "int32": torch.int32,
+    "uint8": torch.uint8,
+    "bool": torch.bool,
+}
+DTYPE_NAMES = {dtype: name for name, dtype in TENSOR_DTYPES.items()}
+
+
+def align(n: int) -> int:
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+
+def save_tensors(tensors: Dict[str, torch.Tensor], path: str) -> None:
+    """
+    Writes tensors to a flat file: the little-endian uint64 length of a JSON
+    header (name -> dtype, shape and offset of the data), the header, then
+    the raw data of every tensor at an aligned offset. The file is written
+    to a temporary path and renamed into place.
+    """
+    entries, offset = {}, 0
+    for name, tensor in tensors.items():
+        if tensor.dtype not in DTYPE_NAMES:
+            raise ValueError(f"Unsupported dtype {tensor.dtype} of tensor {name}")
+        nbytes = tensor.numel() * tensor.element_size()
+        entries[name] = {
+            "dtype": DTYPE_NAMES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "offset": offset,
+            "nbytes": nbytes,
+        }
+        offset = align(offset + nbytes)
+
+    header = json.dumps({"version": ARTIFACT_VERSION, "tensors": entries}).encode()
+    header += b" " * (align(8 + len(header)) - 8 - len(header))
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        data_start = f.tell()
+        for name, tensor in tensors.items():
+            f.seek(data_start + entries[name]["offset"])
+            f.write(tensor.detach().cpu().contiguous().numpy().tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def load_tensors(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Tensors of a file written by save_tensors, memory-mapped without copies.
+    The mapping is copy-on-write: processes loading the same file share its
+    pages, and in-place updates stay private to the process.
+    """
+    with open(path, "rb") as f:
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+    if header["version"] != ARTIFACT_VERSION:
+        raise ValueError(f"Unsupported tensor file version: {header['version']}")
+
+    data_start = 8 + header_len
+    size = os.path.getsize(path) - data_start
+    buffer = np.memmap(path, dtype=np.uint8, mode="c", offset=data_start, shape=(size,)) if size else None
+
+    tensors = {}
+    for name, entry in header["tensors"].items():
+        dtype = TENSOR_DTYPES[entry["dtype"]]
+        if entry["nbytes"] == 0:
+            tensors[name] = torch.empty(entry["shape"], dtype=dtype)
+            continue
+        data = buffer[entry["offset"] : entry["offset"] + entry["nbytes"]]
+        tensors[name] = torch.from_numpy(data).view(dtype).reshape(entry["shape"])
+    return tensors
+
+
+def model_artifact(model: CMVAE) -> Tuple[dict, Dict[str, torch.Tensor]]:
+    """Config and tensors (state_dict and SENA relation edges) of a model artifact."""
+    config = dict(model.config, version=ARTIFACT_VERSION)
+    tensors = dict(model.state_dict())
+    if config["mode"] == "sena":
+        # (GO, gene) edges of the layer, stored as the (gene, GO) edges it is built from
+        tensors["relation_edges"] = relation_edges(model.fc1.relation_dict, model.dim).flip(0)
+    return config, tensors
+
+
+def write_model_artifact(
+    config: dict, tensors: Dict[str, torch.Tensor], artifact_dir: str
+) -> None:
+    """Writes the output of model_artifact to artifact_dir (tensors first, then config)."""
+    os.makedirs(artifact_dir, exist_ok=True)
+    save_tensors(tensors, os.path.join(artifact_dir, TENSOR_FILE))
+    config_path = os.path.join(artifact_dir, CONFIG_FILE)
+    tmp_path = f"{config_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(config, f, indent=4)
+    os.replace(tmp_path, config_path)
+
+
+def save_model_artifact(model: CMVAE, artifact_dir: str) -> None:
+    """Saves model as config.json and a flat tensor file in artifact_dir."""
+    config, tensors = model_artifact(model)
+    write_model_artifact(config, tensors, artifact_dir)
+
+
+def load_model_artifact(
+    artifact_dir: str, device: Optional[torch.device] = None
+) -> CMVAE:
+    """
+    Rebuilds the model saved by save_model_artifact on device (the CPU if
+    None). The model is built on the CPU with views of the memory-mapped
+    tensor file as its parameters and buffers (skipping the random
+    initialization), which are then copied once to any other device.
+    """
+    with open(os.path.join(artifact_dir, CONFIG_FILE), "r") as f:
+        config = json.load(f)
+    if config["version"] != ARTIFACT_VERSION:
+        raise ValueError(f"Unsupported model artifact version: {config['version']}")
+
+    tensors = load_tensors(os.path.join(artifact_dir, TENSOR_FILE))
+    relation = tensors.pop("relation_edges", None)
+    # the weights are replaced by the mapped tensors, so they are not initialized
+    model = cmvae_from_config(config, relation, init_weights=False)
+
+    state = model.state_dict(keep_vars=True)
+    if set(state) != set(tensors):
+        raise ValueError(
+            f"Tensors of {artifact_dir} do not match the model: "
+            f"missing {sorted(set(state) - set(tensors))}, unexpected {sorted(set(tensors) - set(state))}"
+        )
+    for name, tensor in state.items():
+        if tensor.shape != tensors[name].shape:
+            raise ValueError(f"Shape mismatch for {name}: {tuple(tensors[name].shape)} vs {tuple(tensor.shape)}")
+        tensor.data = tensors[name]
+
+    if device is not None and torch.device(device).type != "cpu":
+        model.to(device)
+        # the dense SENA mask is a plain attribute, which Module.to leaves in place
+        if getattr(model.fc1, "mask", None) is not None:
+            model.fc1.mask = model.fc1.mask.to(device)
+        model.device, model.cuda = device, True
+    return model
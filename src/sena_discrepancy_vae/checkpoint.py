@@ -0,0 +1,142 @@
+import os
+import queue
+import random
+import threading
+from typing import Any, Dict, Optional
+
+import numpy as np
+import torch
+
+# bump when the content of training checkpoints changes
+CHECKPOINT_VERSION = 1
+
+CHECKPOINT_FILE = "checkpoint.pt"
+
+
+def snapshot(obj: Any) -> Any:
+    """Copy of a (nested) state with every tensor cloned to the CPU."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def rng_state() -> Dict[str, Any]:
+    """States of the global python, numpy and torch (CPU and CUDA) RNGs."""
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state: Dict[str, Any]) -> None:
+    """Restores the global RNG states saved by rng_state."""
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def loader_parts(loader) -> Dict[str, Any]:
+    """Sampler and (possibly wrapped) dataset of a training loader that have a state_dict."""
+    parts = {
+        "sampler": getattr(loader, "sampler", None),
+        "dataset": loader.dataset,
+        "scdataset": getattr(loader.dataset, "dataset", None),
+    }
+    return {name: part for name, part in parts.items() if hasattr(part, "state_dict")}
+
+
+def loader_state(loader) -> Dict[str, Any]:
+    """
+    Positions of the random streams of a training loader: epoch of the batch
+    plan, control pairing and the generator it is drawn from.
+    """
+    return {name: part.state_dict() for name, part in loader_parts(loader).items()}
+
+
+def load_loader_state(loader, state: Dict[str, Any]) -> None:
+    """Restores the loader state saved by loader_state."""
+    parts = loader_parts(loader)
+    for name, part_state in state.items():
+        parts[name].load_state_dict(part_state)
+
+
+def load_checkpoint(savedir: str) -> Optional[Dict[str, Any]]:
+    """Latest training checkpoint of a run, or None if it has none."""
+    path = os.path.join(savedir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return None
+    # checkpoints hold numpy RNG states and options, which weights-only loading rejects
+    checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+    if checkpoint["version"] != CHECKPOINT_VERSION:
+        raise ValueError(f"Unsupported checkpoint version: {checkpoint['version']}")
+    return checkpoint
+
+
+def atomic_save(obj: Any, path: str) -> None:
+    """torch.save to a temporary file renamed over path, so a crash never leaves a partial file."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter:
+    """
+    Runs writes in a background thread so that training does not wait on
+    disk I/O: save writes an object with atomic_save, submit runs any write
+    function.
+
+    Callers must pass objects that training no longer mutates (see snapshot).
+    At most one write is pending at a time; a call blocks while the previous
+    one is still queued. Errors of the writer are raised on the next call.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Background checkpoint write failed") from error
+
+    def submit(self, fn, *args) -> None:
+        self.check()
+        self.queue.put((fn, args))
+
+    def save(self, obj: Any, path: str) -> None:
+        self.submit(atomic_save, obj, path)
+
+    def wait(self) -> None:
+        """Blocks until every queued write is on disk."""
+        self.queue.join()
+        self.check()
+
+    def close(self) -> None:
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
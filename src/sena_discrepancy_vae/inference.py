@@ -1,15 +1,153 @@
 import argparse
 import json
 import os
-import pickle
-from typing import List, Tuple
+from collections import defaultdict
+from typing import List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 import torch
 from torch.utils.data import DataLoader
 from tqdm import tqdm
-from utils import MMD_loss, LossFunction
+from artifact import CONFIG_FILE, load_model_artifact
+from utils import (
+    MMD_loss,
+    LinearMMD,
+    LossFunction,
+    RandomFourierMMD,
+    Norman2019DataLoader,
+    autocast_context,
+    precision_dtype,
+)
+
+
+MMD_ESTIMATORS = ["exact", "linear", "rff"]
+
+
+def intervention_key(c: torch.Tensor) -> tuple:
+    """Hashable identity of the intervention of one row (encoded vector or target indices)."""
+    if c.is_floating_point():
+        return tuple(torch.nonzero(c).flatten().tolist())
+    return tuple(sorted(c[c >= 0].tolist()))
+
+
+class FoldMetrics:
+    """
+    Streaming accumulator of the evaluation metrics of a whole fold.
+
+    MSE and KLD are running sums, so they equal LossFunction.compute_loss
+    applied to the entire fold at once. MMD is computed per perturbation and
+    averaged over perturbations: "exact" keeps the (y_hat, y) samples of each
+    perturbation on the CPU and evaluates MMD_loss.blockwise over them at the
+    end; "linear" and "rff" only keep the additive statistics of LinearMMD /
+    RandomFourierMMD.
+
+    To bound host memory, "exact" keeps a uniform random subset of at most
+    max_group_samples samples per perturbation (all of them if None), so
+    larger populations get the exact MMD of a subsample. Metrics of an empty
+    fold are NaN.
+    """
+
+    def __init__(
+        self,
+        MMD_sigma: float = 200.0,
+        kernel_num: int = 10,
+        mmd_estimator: str = "exact",
+        rff_features: int = 1024,
+        block_size: int = 1024,
+        dtype: Optional[torch.dtype] = None,
+        max_group_samples: Optional[int] = 4096,
+    ):
+        if mmd_estimator not in MMD_ESTIMATORS:
+            raise ValueError(f"Invalid MMD estimator: {mmd_estimator}. Expected one of {MMD_ESTIMATORS}.")
+        self.MMD_sigma = MMD_sigma
+        self.kernel_num = kernel_num
+        self.mmd_estimator = mmd_estimator
+        self.rff_features = rff_features
+        self.block_size = block_size
+        self.dtype = dtype
+        self.max_group_samples = max_group_samples
+
+        self.estimator = (
+            LinearMMD(fix_sigma=MMD_sigma, kernel_num=kernel_num)
+            if mmd_estimator == "linear"
+            else None
+        )
+        self.group_stats = defaultdict(int)
+        self.group_samples = {}  # perturbation -> (sampling keys, y_hat, y)
+        self.sq_error, self.kld_sum = 0, 0
+        self.x_numel, self.latent_numel, self.n_samples = 0, 0, 0
+
+    def update(self, y_hat, y, x_recon, x, mu, var, c):
+        """Adds a batch, whose rows are grouped by their intervention c."""
+        if self.dtype is not None:
+            x_recon, x, mu, var = (t.to(self.dtype) for t in (x_recon, x, mu, var))
+
+        # sums of the elements averaged by compute_loss
+        self.sq_error += (x_recon - x).pow(2).sum(dtype=torch.float64)
+        logvar = torch.log(var)
+        self.kld_sum += (1 + logvar - mu.pow(2) - logvar.exp()).sum(dtype=torch.float64)
+        self.x_numel += x.numel()
+        self.latent_numel += mu.numel()
+        self.n_samples += x.shape[0]
+
+        y_hat = y_hat.to(y.dtype)
+        interventions, group = torch.unique(c, dim=0, return_inverse=True)
+        for g, intervention in enumerate(interventions):
+            rows = group == g
+            self.update_group(intervention_key(intervention), y_hat[rows], y[rows])
+
+    def update_group(self, key, y_hat, y):
+        if self.mmd_estimator == "exact":
+            # bottom-k sampling: the samples with the smallest random keys form
+            # a uniform subset of everything seen so far
+            samples = (torch.rand(y.shape[0]), y_hat.cpu(), y.cpu())
+            if key in self.group_samples:
+                samples = tuple(torch.cat(t) for t in zip(self.group_samples[key], samples))
+            if self.max_group_samples is not None and samples[0].shape[0] > self.max_group_samples:
+                keep = torch.topk(samples[0], self.max_group_samples, largest=False).indices
+                samples = tuple(t[keep] for t in samples)
+            self.group_samples[key] = samples
+            return
+        if self.estimator is None:
+            self.estimator = RandomFourierMMD(
+                y.shape[1],
+                fix_sigma=self.MMD_sigma,
+                kernel_num=self.kernel_num,
+                num_features=self.rff_features,
+                dtype=y.dtype,
+                device=y_hat.device,
+            )
+        self.group_stats[key] += self.estimator.statistics(y_hat, y.to(y_hat.device))
+
+    def group_mmd(self, device: torch.device) -> List[float]:
+        """MMD of every perturbation seen so far."""
+        if self.mmd_estimator != "exact":
+            return [self.estimator.finalize(stats).item() for stats in self.group_stats.values()]
+
+        mmd_loss_func = MMD_loss(fix_sigma=self.MMD_sigma, kernel_num=self.kernel_num)
+        mmd = []
+        for _, pred_y, gt_y in self.group_samples.values():
+            pred_y, gt_y = pred_y.to(device), gt_y.to(device)
+            mmd.append(mmd_loss_func.blockwise(pred_y, gt_y, self.block_size).item())
+        return mmd
+
+    def compute(
+        self, G: Optional[torch.Tensor], device: torch.device
+    ) -> Tuple[float, float, float, float]:
+        """Returns MMD, MSE, KLD and L1 over everything added so far (NaN if nothing was added)."""
+        if self.x_numel == 0:
+            return float("nan"), float("nan"), float("nan"), float("nan")
+        MSE = (self.sq_error / self.x_numel).item()
+        KLD = (-0.5 * self.kld_sum / self.latent_numel / self.n_samples).item()
+        L1 = (
+            (torch.norm(torch.triu(G, diagonal=1), p=1)
+            / torch.sum(torch.triu(torch.ones_like(G), diagonal=1))).item()
+            if G is not None
+            else 0.0
+        )
+        mmd = self.group_mmd(device)
+        return (np.mean(mmd) if mmd else float("nan")), MSE, KLD, L1
 
 
 def evaluate_generated_samples(
@@ -22,10 +160,22 @@ def evaluate_generated_samples(
     mode: str = "double",
     MMD_sigma: float = 200.0,
     kernel_num: int = 10,
-    batch_size: int = 10,
+    block_size: int = 1024,
+    precision: str = "float64",
+    mmd_estimator: str = "exact",
+    rff_features: int = 1024,
+    max_group_samples: Optional[int] = 4096,
 ) -> Tuple[float, float, float, float]:
     """
-    Evaluate the model on the given dataloader and compute metrics.
+    Evaluate the model on the given dataloader and compute metrics over the
+    whole fold in one streaming pass (see FoldMetrics).
+
+    MMD is computed per perturbation and averaged over perturbations. With
+    mmd_estimator="exact" it is MMD_loss over the population of each
+    perturbation (a uniform subsample of max_group_samples if larger),
+    accumulated over block_size x block_size kernel tiles. With "linear"
+    (LinearMMD) or "rff" (RandomFourierMMD, with rff_features features per
+    bandwidth) it is estimated in O(n) over the whole population.
 
     Returns:
         MMD (float): Mean Maximum Mean Discrepancy
@@ -36,19 +186,24 @@ def evaluate_generated_samples(
     model = model.to(device)
     model.eval()
 
-    pred_x_list, gt_x_list = [], []
-    gt_y_list, pred_y_list = [], []
-    c_y_list, mu_list, var_list = [], [], []
-    MSE_l, KLD_l, L1_l, MMD_l = [], [], [], []
-    
-    #Initialize MMD loss
-    mmd_loss_func = MMD_loss(fix_sigma=MMD_sigma, kernel_num=kernel_num)
+    metrics = FoldMetrics(
+        MMD_sigma=MMD_sigma,
+        kernel_num=kernel_num,
+        mmd_estimator=mmd_estimator,
+        rff_features=rff_features,
+        block_size=block_size,
+        dtype=loss_f.dtype,
+        max_group_samples=max_group_samples,
+    )
 
-    for i, X in enumerate(tqdm(dataloader, desc="evaluating loader")):
+    for X in tqdm(dataloader, desc="evaluating loader"):
 
-        x, y, c = X[0].to(device), X[1], X[2].to(device)
+        x, y, c = X[0].to(device), X[1].to(device), X[2].to(device)
 
-        if numint == 2:
+        if not c.is_floating_point():
+            # target indices: the first target, then the remaining ones
+            c1, c2 = (c[:, :1], c[:, 1:]) if numint == 2 else (c, c)
+        elif numint == 2:
             idx = torch.nonzero(torch.sum(c, axis=0), as_tuple=True)[0]
             c1 = torch.zeros_like(c).to(device)
             c1[:, idx[0]] = 1
@@ -57,59 +212,63 @@ def evaluate_generated_samples(
         else:
             c1 = c2 = c
 
-        with torch.no_grad():
+        with torch.no_grad(), autocast_context(precision, device):
             y_hat, x_recon, z_mu, z_var, G, _ = model(
                 x, c1, c2, num_interv=numint, temp=temp
             )
 
-        gt_x_list.append(x.cpu())
-        pred_x_list.append(x_recon.cpu())
-
-        gt_y_list.append(y)
-        pred_y_list.append(y_hat.cpu())
-
-        c_y_list.append(c.cpu())
-        mu_list.append(z_mu.cpu())
-        var_list.append(z_var.cpu())
-
-        if not i % batch_size:
-
-            # Stack tensors
-            gt_x = torch.vstack(gt_x_list)
-            pred_x = torch.vstack(pred_x_list)
-            gt_y = torch.vstack(gt_y_list)
-            pred_y = torch.vstack(pred_y_list)
-            c_y = torch.vstack(c_y_list)
-            mu = torch.vstack(mu_list)
-            var = torch.vstack(var_list)
-            G = model.G.cpu()
-
-            # Compute metrics
-            _, MSE, KLD, L1 = loss_f.compute_loss(
-                pred_y,
-                gt_y,
-                pred_x,
-                gt_x,
-                mu,
-                var,
-                G
-            )
+        metrics.update(y_hat, y, x_recon, x, z_mu, z_var, c)
+
+    return metrics.compute(model.G.detach(), device)
+
+def load_model(savedir: str, device: Optional[torch.device] = None) -> torch.nn.Module:
+    """
+    Load the best model saved by a training run on device: the model artifact
+    (see artifact.load_model_artifact), or the pickled model of older runs.
+    """
+    artifact_dir = os.path.join(savedir, "best_model")
+    if os.path.exists(os.path.join(artifact_dir, CONFIG_FILE)):
+        return load_model_artifact(artifact_dir, device=device)
+
+    model_path = os.path.join(savedir, "best_model.pt")
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"Model file not found at {model_path}")
+    # pickled modules are rejected by weights-only loading
+    return torch.load(model_path, map_location=device, weights_only=False)
 
-            # Compute MMD
-            MMD = mmd_loss_func(pred_y, gt_y)
 
-            MSE_l.append(MSE.item())
-            KLD_l.append(KLD.item())
-            L1_l.append(L1.item())
-            MMD_l.append(MMD.item())
+def load_data_handler(
+    savedir: str, precision: str = "float64"
+) -> Norman2019DataLoader:
+    """
+    Rebuild the data handler of a run from its split manifest and the shared
+    dataset cache. Older runs, which stored pickled data loaders instead of a
+    manifest, are not supported.
+    """
+    manifest_path = os.path.join(savedir, "split_manifest.json")
+    if not os.path.exists(manifest_path):
+        raise FileNotFoundError(
+            f"Split manifest not found at {manifest_path}. Runs with pickled data "
+            "loaders are no longer supported; train the model again to re-split "
+            "the data and write a manifest."
+        )
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
 
-            # Reset lists
-            pred_x_list, gt_x_list = [], []
-            gt_y_list, pred_y_list = [], []
-            c_y_list, mu_list, var_list = [], [], []
+    config_path = os.path.join(savedir, "config.json")
+    config = {}
+    if os.path.exists(config_path):
+        with open(config_path, "r") as f:
+            config = json.load(f)
 
+    return Norman2019DataLoader.from_split_manifest(
+        manifest,
+        dtype=precision_dtype(precision),
+        backed=config.get("backed", False),
+        stream_buffer_size=config.get("stream_buffer_size", 16384),
+        intervention_encoding=config.get("intervention_encoding", "onehot"),
+    )
 
-    return np.mean(MMD_l), np.mean(MSE_l), np.mean(KLD_l), np.mean(L1_l)
 
 def evaluate_model_generic(
     model: torch.nn.Module,
@@ -120,9 +279,15 @@ def evaluate_model_generic(
     temp: float = 1000.0,
     MMD_sigma: float = 200.0,
     kernel_num: int = 10,
+    precision: str = "float64",
+    data_handler: Optional[Norman2019DataLoader] = None,
+    mmd_estimator: str = "exact",
+    rff_features: int = 1024,
+    max_group_samples: Optional[int] = 4096,
 ) -> Tuple[float, float, float, float]:
     """
     Evaluate the model on the given data type (single left-out, single train, or double perturbation).
+    The data loader is rebuilt from the split manifest of the run.
 
     Args:
         model (torch.nn.Module): The model to evaluate.
@@ -134,29 +299,23 @@ def evaluate_model_generic(
         temp (float): Temperature value for evaluation.
         MMD_sigma (float): Sigma value for MMD calculation.
         kernel_num (int): Number of kernels for MMD.
+        precision (str): Precision mode used for the forward pass.
+        data_handler (Norman2019DataLoader): Data handler rebuilt from the split
+            manifest (see load_data_handler); loaded from savedir if None.
+        mmd_estimator (str): MMD estimator, 'exact', 'linear' or 'rff' (see evaluate_generated_samples).
+        rff_features (int): Number of random Fourier features per bandwidth for 'rff'.
+        max_group_samples (int): Maximum number of samples per perturbation kept for 'exact'
+            (None keeps all of them).
 
     Returns:
         Tuple: MMD, MSE, KLD, L1 losses.
     """
-    # Define file paths based on data type
-    data_file_map = {
-        "train": "train_data.pkl",
-        "test": "test_data_single_node.pkl",
-        "double": "double_data.pkl",
-    }
-
-    if mode not in data_file_map:
+    if mode not in ["train", "test", "double"]:
         raise ValueError(f"Invalid data type: {mode}. Expected 'train', 'test', or 'double'.")
 
-    # Construct the full path to the data file
-    data_path = os.path.join(savedir, data_file_map[mode])
-
-    # Load the data
-    if os.path.exists(data_path):
-        with open(data_path, "rb") as f:
-            dataloader = pickle.load(f)
-    else:
-        raise FileNotFoundError(f"{mode} data file not found at {data_path}")
+    if data_handler is None:
+        data_handler = load_data_handler(savedir, precision)
+    dataloader = data_handler.fold_loader(mode)
 
     # Determine the number of interventions (numint) based on data type
     numint = 1 if mode in ["train", "test"] else 2
@@ -172,6 +331,10 @@ def evaluate_model_generic(
         mode=mode,
         MMD_sigma=MMD_sigma,
         kernel_num=kernel_num,
+        precision=precision,
+        mmd_estimator=mmd_estimator,
+        rff_features=rff_features,
+        max_group_samples=max_group_samples,
     )
 
 def evaluate_model(
@@ -183,6 +346,11 @@ def evaluate_model(
     temp: float,
     MMD_sigma: float,
     kernel_num: int,
+    precision: str = "float64",
+    data_handler: Optional[Norman2019DataLoader] = None,
+    mmd_estimator: str = "exact",
+    rff_features: int = 1024,
+    max_group_samples: Optional[int] = 4096,
 ) -> pd.DataFrame:
     """
     Evaluate the model and return metrics in a DataFrame.
@@ -209,6 +377,11 @@ def evaluate_model(
         temp=temp,
         MMD_sigma=MMD_sigma,
         kernel_num=kernel_num,
+        precision=precision,
+        data_handler=data_handler,
+        mmd_estimator=mmd_estimator,
+        rff_features=rff_features,
+        max_group_samples=max_group_samples,
     )
 
     #build dataframe
@@ -218,7 +391,11 @@ def evaluate_model(
     return df
 
 def compute_metrics(
-    savedir: str, evaluation: List[str] = ["double"]
+    savedir: str,
+    evaluation: List[str] = ["double"],
+    mmd_estimator: str = "exact",
+    rff_features: int = 1024,
+    max_group_samples: Optional[int] = 4096,
 ) -> pd.DataFrame:
     """
     Compute metrics for a given model.
@@ -226,15 +403,15 @@ def compute_metrics(
     Parameters:
         savedir (str): Path to the saved model and config files.
         evaluation (list): list of folds to compute metrics for (['train','test','double'])
+        mmd_estimator (str): MMD estimator, 'exact', 'linear' or 'rff'
+        rff_features (int): Number of random Fourier features per bandwidth for 'rff'
+        max_group_samples (int): Maximum number of samples per perturbation kept for 'exact'
     Returns:
         pd.DataFrame: DataFrame containing the computed metrics.
     """
-    # Load the model
-    model_path = os.path.join(savedir, "best_model.pt")
-    if os.path.exists(model_path):
-        model = torch.load(model_path)
-    else:
-        raise FileNotFoundError(f"Model file not found at {model_path}")
+    # Prepare device and load the model
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = load_model(savedir, device)
 
     # Load config from the savedir
     config_path = os.path.join(savedir, "config.json")
@@ -254,13 +431,18 @@ def compute_metrics(
     seed = config.get("seed", 42)
     latdim = config.get("latdim", 105)
     model_name = config.get("name", "example")
+    precision = config.get("precision", "float64")
 
     #init loss function class
-    loss_f = LossFunction(MMD_sigma=MMD_sigma, kernel_num=kernel_num, matched_IO=matched_IO)
+    loss_f = LossFunction(
+        MMD_sigma=MMD_sigma,
+        kernel_num=kernel_num,
+        matched_IO=matched_IO,
+        dtype=precision_dtype(precision),
+    )
 
-    # Prepare device
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model.to(device)
+    # Rebuild the data loaders once for all folds
+    data_handler = load_data_handler(savedir, precision)
 
     # init list
     df_list = []
@@ -276,6 +458,11 @@ def compute_metrics(
             temp=temp,
             MMD_sigma=MMD_sigma,
             kernel_num=kernel_num,
+            precision=precision,
+            data_handler=data_handler,
+            mmd_estimator=mmd_estimator,
+            rff_features=rff_features,
+            max_group_samples=max_group_samples,
         )
         df["mode"] = mode  # Add the mode as a column to the DataFrame
         df_list.append(df)  # Append the results to the list
@@ -309,8 +496,31 @@ if __name__ == "__main__":
         default=["double"],
         help="Which folds to evaluate (train, test and/or double)",
     )
+    parser.add_argument(
+        "--mmd_estimator",
+        type=str,
+        default="exact",
+        choices=MMD_ESTIMATORS,
+        help="MMD estimator per perturbation: exact (blockwise), linear or rff",
+    )
+    parser.add_argument(
+        "--rff_features",
+        type=int,
+        default=1024,
+        help="Number of random Fourier features per bandwidth for the rff estimator",
+    )
+    parser.add_argument(
+        "--max_group_samples",
+        type=int,
+        default=4096,
+        help="Maximum number of samples per perturbation kept for the exact estimator (0 keeps all)",
+    )
     args = parser.parse_args()
 
     metrics_df = compute_metrics(
-        savedir=args.savedir, evaluation=args.evaluation
+        savedir=args.savedir,
+        evaluation=args.evaluation,
+        mmd_estimator=args.mmd_estimator,
+        rff_features=args.rff_features,
+        max_group_samples=args.max_group_samples or None,
     )
@@ -2,15 +2,16 @@ import argparse
 import json
 import logging
 import os
-import pickle
 import random
 from dataclasses import asdict, dataclass
-from typing import Any, Optional, Tuple
+from typing import Optional, Tuple
 
 import numpy as np
 import torch
+import torch.distributed as dist
+from checkpoint import load_checkpoint
 from train import train
-from utils import Norman2019DataLoader
+from utils import Norman2019DataLoader, precision_dtype
 
 # Set up logging
 logging.basicConfig(
@@ -29,7 +30,11 @@ class Options:
     model: str = "sena"
     dataset_name: str = "Norman2019_reduced"
     batch_size: int = 32
+    groups_per_batch: int = 1
+    resume: bool = False
+    distributed: bool = False
     sena_lambda: float = 0
+    sena_sparse: bool = False
     lr: float = 1e-3
     epochs: int = 100
     grad_clip: bool = False
@@ -42,6 +47,15 @@ class Options:
     matched_IO: bool = False
     latdim: int = 105
     seed: int = 42
+    precision: str = "float64"
+    resident: bool = False
+    ctrl_pairing: str = "fixed"
+    backed: bool = False
+    stream_buffer_size: int = 16384
+    num_workers: int = 0
+    persistent_workers: bool = False
+    pin_memory: bool = False
+    intervention_encoding: str = "onehot"
     dim: Optional[int] = None
     cdim: Optional[int] = None
     log: bool = False
@@ -69,10 +83,84 @@ def parse_args() -> argparse.Namespace:
 
     parser.add_argument("--latdim", type=int, default=105, help="Latent dimension.")
     parser.add_argument("--seed", type=int, default=42, help="Random seed.")
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="float64",
+        choices=["float64", "float32", "bf16"],
+        help="Numeric precision of the model, data and loss.",
+    )
     parser.add_argument(
         "--epochs", type=int, default=100, help="Number of training epochs."
     )
     parser.add_argument("--sena_lambda", type=float, default=0, help="Sena λ value")
+    parser.add_argument(
+        "--sena_sparse",
+        action="store_true",
+        help="Store only the gene-GO edges of the SENA layer (requires sena_lambda=0)",
+    )
+    parser.add_argument(
+        "--resident",
+        action="store_true",
+        help="Keep the dataset in tensors on the training device",
+    )
+    parser.add_argument(
+        "--ctrl_pairing",
+        type=str,
+        default="fixed",
+        choices=["fixed", "epoch", "batch"],
+        help="When to redraw the control cell paired with each perturbed cell.",
+    )
+    parser.add_argument(
+        "--backed",
+        action="store_true",
+        help="Read cells from the h5ad file on demand and stream batches from it",
+    )
+    parser.add_argument(
+        "--stream_buffer_size",
+        type=int,
+        default=16384,
+        help="Number of cells held in the shuffle buffer in backed mode.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=0,
+        help="Number of worker processes building batches.",
+    )
+    parser.add_argument(
+        "--persistent_workers",
+        action="store_true",
+        help="Keep the worker processes alive across epochs",
+    )
+    parser.add_argument(
+        "--pin_memory",
+        action="store_true",
+        help="Stage batches in pinned host memory for asynchronous copies",
+    )
+    parser.add_argument(
+        "--intervention_encoding",
+        type=str,
+        default="onehot",
+        choices=["onehot", "index"],
+        help="Pass interventions to the model as one-hot vectors or target indices.",
+    )
+    parser.add_argument(
+        "--groups_per_batch",
+        type=int,
+        default=1,
+        help="Number of single-perturbation groups of batch_size cells in each training batch",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue training from the latest checkpoint of the run",
+    )
+    parser.add_argument(
+        "--distributed",
+        action="store_true",
+        help="Data-parallel training over the processes launched by torchrun (gloo backend)",
+    )
     parser.add_argument(
         "--log", action='store_true', help="flow server log system"
     )
@@ -86,6 +174,18 @@ def set_seeds(seed: int) -> None:
     random.seed(seed)
 
 
+def init_distributed(device: str) -> Tuple[int, int, str]:
+    """
+    Joins the process group set up by torchrun, on the gloo backend so that it
+    also runs on CPU-only nodes. Returns the rank, the world size and the
+    device of this process (its local GPU if device is a CUDA device).
+    """
+    dist.init_process_group(backend="gloo")
+    if device.startswith("cuda"):
+        device = f"cuda:{os.environ.get('LOCAL_RANK', 0)}"
+    return dist.get_rank(), dist.get_world_size(), device
+
+
 def save_config(opts: Options, save_dir: str) -> None:
     """Save the configuration options to a JSON file."""
     config_path = os.path.join(save_dir, "config.json")
@@ -93,10 +193,11 @@ def save_config(opts: Options, save_dir: str) -> None:
         json.dump(asdict(opts), f, indent=4)
 
 
-def save_pickle(data: Any, filepath: str) -> None:
-    """Save data to a pickle file."""
-    with open(filepath, "wb") as f:
-        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+def save_split_manifest(data_handler: Norman2019DataLoader, save_dir: str) -> None:
+    """Save the split manifest from which inference rebuilds the data loaders."""
+    manifest_path = os.path.join(save_dir, "split_manifest.json")
+    with open(manifest_path, "w") as f:
+        json.dump(data_handler.split_manifest(), f)
 
 
 def main(args: argparse.Namespace) -> None:
@@ -107,19 +208,66 @@ def main(args: argparse.Namespace) -> None:
         epochs=args.epochs,
         latdim=args.latdim,
         seed=args.seed,
+        precision=args.precision,
+        resident=args.resident,
+        ctrl_pairing=args.ctrl_pairing,
+        backed=args.backed,
+        stream_buffer_size=args.stream_buffer_size,
+        num_workers=args.num_workers,
+        persistent_workers=args.persistent_workers,
+        pin_memory=args.pin_memory,
+        intervention_encoding=args.intervention_encoding,
+        groups_per_batch=args.groups_per_batch,
+        resume=args.resume,
+        distributed=args.distributed,
         model=args.model,
         sena_lambda=args.sena_lambda,
+        sena_sparse=args.sena_sparse,
         name=args.name,
         dataset_name=args.dataset
     )
 
+    rank, world_size, device = 0, 1, args.device
+    if opts.distributed:
+        rank, world_size, device = init_distributed(args.device)
+        # only rank 0 reports progress
+        if rank != 0:
+            logging.getLogger().setLevel(logging.WARNING)
+        logging.info(f"Distributed training over {world_size} processes")
+
     logging.info(f"Configuration: {opts}")
 
     # Set random seeds
     set_seeds(opts.seed)
 
+    checkpoint = load_checkpoint(args.savedir) if opts.resume else None
+    if opts.resume and checkpoint is None:
+        logging.info("No checkpoint found, training from scratch")
+
     logging.info("Loading data...")
-    data_handler = Norman2019DataLoader(batch_size=opts.batch_size, dataname=opts.dataset_name)
+    data_handler = Norman2019DataLoader(
+        batch_size=opts.batch_size,
+        dataname=opts.dataset_name,
+        dtype=precision_dtype(opts.precision),
+        resident_device=device if opts.resident else None,
+        ctrl_pairing=opts.ctrl_pairing,
+        seed=opts.seed,
+        backed=opts.backed,
+        stream_buffer_size=opts.stream_buffer_size,
+        num_workers=opts.num_workers,
+        persistent_workers=opts.persistent_workers,
+        pin_memory=opts.pin_memory,
+        intervention_encoding=opts.intervention_encoding,
+        groups_per_batch=opts.groups_per_batch,
+        num_replicas=world_size,
+        rank=rank,
+    )
+
+    # A resumed run keeps the split it was started with
+    test_idx = None
+    if checkpoint is not None:
+        with open(os.path.join(args.savedir, "split_manifest.json"), "r") as f:
+            test_idx = json.load(f)["test_idx"]
 
     # Get data from single-gene perturbation
     (
@@ -128,12 +276,7 @@ def main(args: argparse.Namespace) -> None:
         dim,
         cdim,
         ptb_targets,
-    ) = data_handler.get_data(mode="train")
-
-    # Get data from double perturbation
-    dataloader_double, _, _, _ = data_handler.get_data(
-        mode="test", perturb_targets=ptb_targets
-    )
+    ) = data_handler.get_data(mode="train", test_idx=test_idx)
 
     opts.dim = dim
     opts.cdim = cdim
@@ -145,22 +288,24 @@ def main(args: argparse.Namespace) -> None:
     logging.info("Saving configuration dict...")
 
     # Save configurations and data
-    save_config(opts, args.savedir)
-    save_pickle(ptb_targets, os.path.join(args.savedir, "ptb_targets.pkl"))
-    save_pickle(dataloader2, os.path.join(args.savedir, "test_data_single_node.pkl"))
-    save_pickle(dataloader, os.path.join(args.savedir, "train_data.pkl"))
-    save_pickle(dataloader_double, os.path.join(args.savedir, "double_data.pkl"))
+    if rank == 0:
+        save_config(opts, args.savedir)
+        save_split_manifest(data_handler, args.savedir)
 
     # Train the model
     train(
         dataloader=dataloader,
         opts=opts,
-        device=args.device,
+        device=device,
         savedir=args.savedir,
         logger=logging,
         data_handler=data_handler,
+        checkpoint=checkpoint,
     )
 
+    if opts.distributed:
+        dist.destroy_process_group()
+
 
 if __name__ == "__main__":
     args = parse_args()
@@ -4,11 +4,17 @@ import math
 import torch
 import torch.nn as nn
 import utils as ut
-from torch.autograd import Variable
 from torch.nn import functional as F
 
 importlib.reload(ut)
 
+# the edge indices of the sparse SENA layer are sorted and unique, so its COO
+# weight can skip coalescing and index checks (flags available from torch 2.1)
+TORCH_VERSION = tuple(int(v) for v in torch.__version__.split("+")[0].split(".")[:2])
+COALESCED_COO_KWARGS = (
+    {"is_coalesced": True, "check_invariants": False} if TORCH_VERSION >= (2, 1) else {}
+)
+
 
 class NetworkActivity_layer(torch.nn.Module):
 
@@ -21,57 +27,122 @@ class NetworkActivity_layer(torch.nn.Module):
         device=None,
         dtype=None,
         lambda_parameter=0,
+        sparse=False,
+        init_weights=True,
     ):
         factory_kwargs = {"device": device, "dtype": dtype}
         super().__init__()
         self.input_genes = input_genes
         self.output_gs = output_gs
         self.relation_dict = relation_dict
+        self.sparse = sparse
 
-        ## create sparse weight matrix according to GO relationships
-        mask = torch.zeros((self.input_genes, self.output_gs), **factory_kwargs)
+        if self.sparse:
 
-        ## set to 1 remaining values
-        for i in range(self.input_genes):
-            for latent_go in self.relation_dict[i]:
-                mask[i, latent_go] = 1
+            # only the gene->GO edges are trainable, so λ has to be 0
+            if lambda_parameter != 0:
+                raise ValueError("sparse NetworkActivity_layer requires lambda_parameter=0")
 
-        #include λ
-        self.mask = mask
-        self.mask[self.mask == 0] = lambda_parameter
+            # (2, nnz) indices of the GO x gene weight, sorted so that the COO tensor is coalesced
+            self.register_buffer("edge_index", relation_edges(relation_dict, input_genes).to(device))
+            self.mask = None
+            self.weight = nn.Parameter(
+                torch.empty(self.edge_index.shape[1], **factory_kwargs)
+            )
 
-        # apply sp
-        self.weight = nn.Parameter(
-            torch.empty((self.output_gs, self.input_genes), **factory_kwargs)
-        )
+        else:
+
+            ## create sparse weight matrix according to GO relationships
+            mask = torch.zeros((self.input_genes, self.output_gs), **factory_kwargs)
+
+            ## set to 1 remaining values (single scatter over the gene-GO edges)
+            go_idx, gene_idx = relation_edges(relation_dict, input_genes).to(mask.device)
+            mask[gene_idx, go_idx] = 1
+
+            #include λ
+            self.mask = mask
+            self.mask[self.mask == 0] = lambda_parameter
+
+            # apply sp
+            self.weight = nn.Parameter(
+                torch.empty((self.output_gs, self.input_genes), **factory_kwargs)
+            )
 
         if bias:
             self.bias = nn.Parameter(torch.empty(self.output_gs, **factory_kwargs))
         else:
             self.register_parameter("bias", None)
 
-        self.reset_parameters()
+        if init_weights:
+            self.reset_parameters()
 
     def forward(self, x):
-        output = x @ ((self.weight * self.mask.T).T)
+        if self.sparse:
+            # (GO x gene) sparse @ (gene x batch) dense, gradients flow to the edge values only
+            # (sparse kernels have no autocast support, so this runs in the weight dtype)
+            weight = torch.sparse_coo_tensor(
+                self.edge_index,
+                self.weight,
+                (self.output_gs, self.input_genes),
+                **COALESCED_COO_KWARGS,
+            )
+            with torch.autocast(device_type=x.device.type, enabled=False):
+                output = torch.sparse.mm(weight, x.to(self.weight.dtype).T).T
+        else:
+            output = x @ ((self.weight * self.mask.T).T)
         if self.bias is not None:
             return output + self.bias
         return output
 
+    def masked_weight(self):
+        """Dense (output_gs, input_genes) weight actually applied by the layer."""
+        if self.sparse:
+            weight = torch.zeros(
+                (self.output_gs, self.input_genes),
+                dtype=self.weight.dtype,
+                device=self.weight.device,
+            )
+            return weight.index_put((self.edge_index[0], self.edge_index[1]), self.weight)
+        return self.weight * self.mask.T
+
     def reset_parameters(self) -> None:
         # Setting a=sqrt(5) in kaiming_uniform is the same as initializing with
         # uniform(-1/sqrt(in_features), 1/sqrt(in_features)). For details, see
         # https://github.com/pytorch/pytorch/issues/57109
-        nn.init.kaiming_uniform_(self.weight, a=math.sqrt(5))
+        fan_in = self.input_genes
+        if self.sparse:
+            # same distribution as the masked entries of the dense layer
+            bound = 1 / math.sqrt(fan_in) if fan_in > 0 else 0
+            nn.init.uniform_(self.weight, -bound, bound)
+        else:
+            nn.init.kaiming_uniform_(self.weight, a=math.sqrt(5))
         if self.bias is not None:
-            fan_in, _ = nn.init._calculate_fan_in_and_fan_out(self.weight)
             bound = 1 / math.sqrt(fan_in) if fan_in > 0 else 0
             nn.init.uniform_(self.bias, -bound, bound)
 
 
+def relation_edges(relation_dict, num_genes):
+    """
+    Convert gene-GO relations into a (2, nnz) LongTensor of unique
+    (GO index, gene index) pairs, sorted by GO and then by gene.
+
+    relation_dict is either a gene -> [GO] dict or a (2, nnz) array of
+    (gene index, GO index) edges, as built by Norman2019DataLoader.
+    """
+    if isinstance(relation_dict, dict):
+        genes = [gene for gene, gos in relation_dict.items() for _ in gos]
+        gos = [go for _, gos in relation_dict.items() for go in gos]
+        edges = torch.tensor([genes, gos], dtype=torch.long).reshape(2, -1)
+    else:
+        edges = torch.as_tensor(relation_dict, dtype=torch.long).reshape(2, -1)
+    keys = torch.unique(edges[1].cpu() * num_genes + edges[0].cpu())
+    return torch.stack([keys // num_genes, keys % num_genes])
+
+
 # VAE model with causal layer and mmd loss
 # "dim" specifies the sample dimension; "c_dim" specifies the dimension of the intervention encoding.
 #  "z_dim" specifies the dimension of the latent space.
+#  "init_weights=False" skips the random initialization, for models whose state is loaded right after.
 class CMVAE(nn.Module):
     def __init__(
         self,
@@ -83,9 +154,14 @@ class CMVAE(nn.Module):
         gos=None,
         rel_dict=None,
         sena_lambda=None,
+        sena_sparse=False,
+        init_weights=True,
     ):
         super(CMVAE, self).__init__()
 
+        if sena_sparse and mode != "sena":
+            raise ValueError(f"sena_sparse requires mode='sena', got mode='{mode}'")
+
         if device is None:
             self.cuda = False
             self.device = "cpu"
@@ -97,27 +173,51 @@ class CMVAE(nn.Module):
         self.c_dim = c_dim
         self.dim = dim
 
+        # constructor arguments, from which cmvae_from_config rebuilds the model
+        self.config = {
+            "dim": dim,
+            "z_dim": z_dim,
+            "c_dim": c_dim,
+            "mode": mode,
+            "num_gos": len(gos),
+            "sena_lambda": sena_lambda,
+            "sena_sparse": sena_sparse,
+        }
+
         if mode == "mlp":
 
             self.fc1 = nn.Linear(self.dim, len(gos))
-            weights_init(self.fc1)
+            if init_weights:
+                weights_init(self.fc1)
 
         elif mode == "sena":
 
             # connect initial gene space to gene sets
             self.fc1 = NetworkActivity_layer(
-                self.dim, len(gos), rel_dict, device=device, lambda_parameter=sena_lambda
+                self.dim,
+                len(gos),
+                rel_dict,
+                device=device,
+                lambda_parameter=sena_lambda,
+                sparse=sena_sparse,
+                init_weights=init_weights,
             )
 
         # mean and var
         self.fc_mean = nn.Linear(len(gos), z_dim)
-        weights_init(self.fc_mean)
+        if init_weights:
+            weights_init(self.fc_mean)
         self.fc_var = nn.Linear(len(gos), z_dim)
-        weights_init(self.fc_var)
+        if init_weights:
+            weights_init(self.fc_var)
 
         # DAG matrix G (upper triangular, z_dim x z_dim).
         # encoded as a dense matrix, where only upper triangular parts will be used
-        self.G = torch.nn.Parameter(torch.normal(0, 0.1, size=(self.z_dim, self.z_dim)))
+        self.G = torch.nn.Parameter(
+            torch.normal(0, 0.1, size=(self.z_dim, self.z_dim))
+            if init_weights
+            else torch.empty(self.z_dim, self.z_dim)
+        )
 
         # C encoder
         hids = 128
@@ -128,8 +228,9 @@ class CMVAE(nn.Module):
         # decoder
         self.d1 = nn.Linear(self.z_dim, hids)
         self.d2 = nn.Linear(hids, self.dim)
-        weights_init(self.d1)
-        weights_init(self.d2)
+        if init_weights:
+            weights_init(self.d1)
+            weights_init(self.d2)
 
         # activation functions
         self.leakyrelu = nn.LeakyReLU(0.2)
@@ -143,68 +244,158 @@ class CMVAE(nn.Module):
 
     def reparametrize(self, mu, var):
         std = torch.sqrt(var)
-        if self.cuda:
-            eps = torch.DoubleTensor(std.size()).normal_().to(self.device)
-        else:
-            eps = torch.DoubleTensor(std.size()).normal_()
-        eps = Variable(eps)
+        # noise is drawn directly on std's device and in its dtype
+        eps = torch.randn_like(std)
         return eps.mul(std).add_(mu)
 
     def decode(self, u):
         h = self.leakyrelu(self.d1(u))
         return self.leakyrelu(self.d2(h))
 
-    def c_encode(self, c, temp=1):
-        h = self.leakyrelu(self.c1(c))
-        h = self.sftmx(self.c2(h) * temp)
-        s = c @ self.c_shift
+    def c_encode(self, c, temp=1, dose=None):
+        """
+        Encodes interventions into a soft latent target h and a shift size s.
+
+        c is either a (batch, c_dim) float encoding (one-hot, or multi-hot
+        scaled by dosage), or a (batch, k) integer tensor of target indices
+        padded with -1, with an optional (batch, k) dosage (default 1). Integer
+        targets are encoded one by one with embedding lookups into c1 and a
+        gather of c_shift, as for a one-hot vector of each target: h is then
+        (batch, k, z_dim) and s is (batch, k), zero at padded slots.
+        """
+        if c.is_floating_point():
+            h = self.leakyrelu(self.c1(c))
+            h = self.sftmx(self.c2(h) * temp)
+            s = c @ self.c_shift
+            return h, s
+
+        scale = (c >= 0).to(self.c_shift.dtype)
+        if dose is not None:
+            scale = scale * dose
+        idx = c.clamp(min=0)
+        h = F.embedding(idx, self.c1.weight.t()) * scale.unsqueeze(-1) + self.c1.bias
+        h = torch.softmax(self.c2(self.leakyrelu(h)) * temp, dim=-1)
+        s = self.c_shift[idx] * scale
         return h, s
 
+    def dag_propagator(self):
+        """
+        Returns (I - triu(G, 1))^-1, the matrix that propagates exogenous noise
+        through the causal DAG. Since triu(G, 1) is strictly upper triangular,
+        I - triu(G, 1) is unit upper triangular and is inverted with a
+        triangular solve instead of a general inverse. Without autograd
+        (e.g. at inference) the result is cached until G changes.
+        """
+        G = self.G
+        needs_grad = torch.is_grad_enabled() and G.requires_grad
+        key = (G._version, G.data_ptr(), G.dtype, G.device)
+        if not needs_grad and getattr(self, "_propagator_key", None) == key:
+            return self._propagator
+
+        eye = torch.eye(self.z_dim, dtype=G.dtype, device=G.device)
+        propagator = torch.linalg.solve_triangular(
+            eye - torch.triu(G, diagonal=1), eye, upper=True, unitriangular=True
+        )
+
+        if not needs_grad:
+            self._propagator, self._propagator_key = propagator, key
+        return propagator
+
     # Causal DAG "layer"
     # bc is a softmax vector encoding the target of the intervetnion
     # csz encodes the strength of the intervention
-    def dag(self, z, bc, csz, bc2, csz2, num_interv=1):
+    def dag(self, z, bc, csz, bc2=None, csz2=None, num_interv=1, propagator=None, rows=None):
+        if propagator is None:
+            propagator = self.dag_propagator()
+        return self.intervene(z, bc, csz, bc2, csz2, num_interv, rows) @ propagator
+
+    def intervene(self, z, bc, csz, bc2=None, csz2=None, num_interv=1, rows=None):
+        """
+        Shifts the latents z by the interventions. If rows is given, bc
+        (n, z_dim) and csz (n,) hold n interventions, the i-th applied to row
+        rows[i] of z, so rows may receive any number of interventions; they
+        are added with one scatter-add. Otherwise bc, csz (and bc2, csz2) are
+        the first (and second) intervention of every row.
+        """
         if num_interv == 0:
-            u = (z) @ torch.inverse(
-                torch.eye(self.z_dim).to(self.device) - torch.triu((self.G), diagonal=1)
-            )
-        else:
-            if num_interv == 1:  # 1 - bc
-                zinterv = z * (1.0) + bc * csz.reshape(-1, 1)
-            else:  # 1. - bc - bc2
-                zinterv = (
-                    z * (1.0) + bc * csz.reshape(-1, 1) + bc2 * csz2.reshape(-1, 1)
-                )
-
-            u = (zinterv) @ torch.inverse(
-                torch.eye(self.z_dim).to(self.device) - torch.triu((self.G), diagonal=1)
-            )
-        return u
-
-    def forward(self, x, c, c2, num_interv=1, temp=1):
+            return z
+        if rows is not None:
+            return z.index_add(0, rows, (bc * csz.unsqueeze(1)).to(z.dtype))
+        if num_interv == 1:  # 1 - bc
+            return z * (1.0) + bc * csz.reshape(-1, 1)
+        # 1. - bc - bc2
+        return z * (1.0) + bc * csz.reshape(-1, 1) + bc2 * csz2.reshape(-1, 1)
+
+    def forward(self, x, c, c2, num_interv=1, temp=1, dose=None):
+        """
+        c and c2 are the first and second interventions as float encodings,
+        of which num_interv (0, 1 or 2) are applied.
+
+        Alternatively c and c2 hold integer target indices padded with -1 (see
+        c_encode), with an optional dosage of c. Every target of c is applied,
+        so a batch can mix rows with any numbers of targets, followed by the
+        targets of c2 if num_interv is 2; num_interv 0 disables interventions.
+        The returned bc is the sum of the latent targets of each row.
+        """
         assert num_interv in [
             0,
             1,
             2,
         ], "support single- or double-node interventions only"
 
-        # decode an interventional sample from an observational sample
-        bc, csz = self.c_encode(c, temp)
-        bc2, csz2 = self.c_encode(c2, temp)
-
         mu, var = self.encode(x)
         z = self.reparametrize(mu, var)
-        u = self.dag(z, bc, csz, bc2, csz2, num_interv)
-
-        y_hat = self.decode(u)
 
-        # create the reconstruction of observational sample
-        u_recon = self.dag(z, bc * 0, csz * 0, bc * 0, csz * 0, num_interv=0)
-        x_recon = self.decode(u_recon)
+        # decode an interventional sample from an observational sample
+        if c.is_floating_point():
+            bc, csz = self.c_encode(c, temp)
+            bc2, csz2 = (bc, csz) if c2 is c else self.c_encode(c2, temp)
+            zinterv = self.intervene(z, bc, csz, bc2, csz2, num_interv)
+        else:
+            if num_interv == 2:
+                c = torch.cat([c, c2], dim=1)
+                if dose is not None:
+                    dose = torch.cat([dose, torch.ones_like(c2, dtype=dose.dtype)], dim=1)
+
+            # encode only the targets that are present, as (row, target) pairs
+            valid = c >= 0
+            rows = valid.nonzero(as_tuple=True)[0]
+            targets = c[valid].unsqueeze(1)
+            target_dose = None if dose is None else dose[valid].unsqueeze(1)
+            bc, csz = self.c_encode(targets, temp, target_dose)
+            bc, csz = bc[:, 0], csz[:, 0]
+
+            zinterv = self.intervene(z, bc, csz, num_interv=num_interv, rows=rows)
+            bc = torch.zeros_like(z).index_add(0, rows, bc.to(z.dtype))
+
+        # propagate and decode the interventional and the observational
+        # (reconstruction) latents as one stacked batch
+        u = torch.cat([zinterv, z]) @ self.dag_propagator()
+        y_hat, x_recon = self.decode(u).split(z.shape[0])
 
         return y_hat, x_recon, mu, var, self.G, bc
 
 
+def cmvae_from_config(config, relation=None, device=None, init_weights=True):
+    """
+    Builds an untrained CMVAE from CMVAE.config. relation holds the (2, nnz)
+    (gene index, GO index) edges of the SENA layer (required for mode 'sena').
+    With init_weights=False the weights are left uninitialized, to be loaded.
+    """
+    return CMVAE(
+        dim=config["dim"],
+        z_dim=config["z_dim"],
+        c_dim=config["c_dim"],
+        device=device,
+        mode=config["mode"],
+        gos=range(config["num_gos"]),
+        rel_dict=relation,
+        sena_lambda=config["sena_lambda"],
+        sena_sparse=config["sena_sparse"],
+        init_weights=init_weights,
+    )
+
+
 def weights_init(m):
     if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d)):
         truncated_normal_(m.weight.data, mean=0, std=0.02)
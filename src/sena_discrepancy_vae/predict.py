@@ -0,0 +1,235 @@
+import argparse
+import itertools
+import json
+import os
+from typing import List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import torch
+from tqdm import tqdm
+from inference import load_data_handler, load_model
+from utils import autocast_context
+
+
+class PairwisePredictor:
+    """
+    Predicts the mean expression of a control population under many
+    combinations of interventions.
+
+    The DAG is linear, so the propagated latent of control cell i under the
+    targets of a combination is zP_i + sum_t shift_t, where zP = z @ (I - G)^-1
+    and shift_t = (bc_t * csz_t) @ (I - G)^-1. zP is computed once for the
+    control population and shift_t once per target, from c_encode outputs;
+    only the decoder runs per combination.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        x_ctrl: torch.Tensor,
+        temp: float = 1000.0,
+        precision: str = "float64",
+        batch_size: int = 4096,
+    ):
+        self.model = model.eval()
+        self.precision = precision
+        self.batch_size = batch_size
+        param = next(model.parameters())
+        self.device, self.dtype = param.device, param.dtype
+
+        with torch.no_grad(), autocast_context(precision, self.device):
+            propagator = model.dag_propagator()
+
+            # observational latents of the control cells, propagated through the DAG
+            zP = []
+            for xb in torch.split(x_ctrl, batch_size):
+                mu, var = model.encode(xb.to(device=self.device, dtype=self.dtype))
+                zP.append(model.reparametrize(mu, var) @ propagator)
+            self.zP = torch.cat(zP)
+
+            # propagated shift of every target, plus a zero row selected by -1 padding
+            targets = torch.arange(model.c_dim, device=self.device).unsqueeze(1)
+            bc, csz = model.c_encode(targets, temp)
+            shift = (bc[:, 0] * csz).to(propagator.dtype) @ propagator
+            self.shift = torch.cat([shift, torch.zeros_like(shift[:1])])
+
+            self.ctrl_mean = self.decode_mean(self.zP.unsqueeze(0))[0]
+
+    def decode_mean(self, u: torch.Tensor) -> torch.Tensor:
+        """Decodes (m, n_ctrl, z_dim) latents and averages over the control cells."""
+        m, n, z_dim = u.shape
+        x = self.model.decode(u.reshape(-1, z_dim))
+        return x.reshape(m, n, -1).float().mean(dim=1)
+
+    def predict(self, targets: torch.Tensor) -> torch.Tensor:
+        """
+        Mean predicted expression (m, n_genes) under each row of targets, an
+        (m, k) integer tensor of target indices padded with -1.
+        """
+        targets = torch.as_tensor(targets, device=self.device)
+        with torch.no_grad(), autocast_context(self.precision, self.device):
+            shift = self.shift[targets].sum(dim=1)
+            return self.decode_mean(self.zP.unsqueeze(0) + shift.unsqueeze(1))
+
+    def predict_to_disk(
+        self,
+        targets: np.ndarray,
+        target_names: Sequence[str],
+        outdir: str,
+        chunk_rows: int = 1 << 16,
+    ) -> pd.DataFrame:
+        """
+        Predicts every row of targets in chunks of about chunk_rows decoded
+        cells, streaming to outdir:
+            mean_expression.npy: (m, n_genes) mean predicted expression
+            shift.npy: (m, n_genes) mean_expression minus the predicted control mean
+            control_mean.npy: (n_genes,) predicted mean expression of the controls
+            summary.tsv: targets and the L2 norm and mean absolute value of the shift
+
+        Returns the summary table.
+        """
+        os.makedirs(outdir, exist_ok=True)
+        targets = np.asarray(targets, dtype=np.int64)
+        n_genes = self.ctrl_mean.shape[0]
+        ctrl_mean = self.ctrl_mean.cpu().numpy()
+        np.save(os.path.join(outdir, "control_mean.npy"), ctrl_mean)
+
+        mean_out = np.lib.format.open_memmap(
+            os.path.join(outdir, "mean_expression.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(targets), n_genes),
+        )
+        shift_out = np.lib.format.open_memmap(
+            os.path.join(outdir, "shift.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(targets), n_genes),
+        )
+
+        names = np.append(np.asarray(target_names, dtype=object), "")
+        summary_path = os.path.join(outdir, "summary.tsv")
+        chunk = max(1, chunk_rows // self.zP.shape[0])
+        for start in tqdm(range(0, len(targets), chunk), desc="predicting", unit="chunk"):
+            rows = targets[start : start + chunk]
+            mean = self.predict(torch.from_numpy(rows)).cpu().numpy()
+            shift = mean - ctrl_mean
+            mean_out[start : start + len(rows)] = mean
+            shift_out[start : start + len(rows)] = shift
+
+            summary = pd.DataFrame(
+                {f"target_{j + 1}": names[rows[:, j]] for j in range(rows.shape[1])}
+            )
+            summary["shift_l2"] = np.linalg.norm(shift, axis=1)
+            summary["shift_mean_abs"] = np.abs(shift).mean(axis=1)
+            summary.to_csv(
+                summary_path, sep="\t", index=False, mode="w" if start == 0 else "a", header=start == 0
+            )
+
+        mean_out.flush()
+        shift_out.flush()
+        return pd.read_csv(summary_path, sep="\t", keep_default_na=False)
+
+
+def observed_pairs(data_handler) -> set:
+    """Pairs of target indices with combinatorial cells in the dataset."""
+    codes = np.asarray(data_handler.ptb_codes)
+    double = (codes >= 0).sum(axis=1) == 2
+    return set(map(tuple, np.sort(codes[double][:, :2], axis=1).tolist()))
+
+
+def predict_pairs(
+    savedir: str,
+    pairs: Optional[List[List[str]]] = None,
+    unseen_only: bool = False,
+    n_ctrl: Optional[int] = None,
+    chunk_rows: int = 1 << 16,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Predicts the double perturbations in pairs (all pairs of ptb_targets if
+    None, optionally without those observed in the data) for the control
+    cells of a trained run, and writes the results to savedir/pairwise.
+    """
+    config_path = os.path.join(savedir, "config.json")
+    config = {}
+    if os.path.exists(config_path):
+        with open(config_path, "r") as f:
+            config = json.load(f)
+    precision = config.get("precision", "float64")
+    temp = config.get("temp", 1000.0)
+
+    data_handler = load_data_handler(savedir, precision)
+    ptb_targets = list(data_handler.ptb_targets)
+    target_index = {t: i for i, t in enumerate(ptb_targets)}
+
+    if pairs is None:
+        targets = np.array(list(itertools.combinations(range(len(ptb_targets)), 2)))
+    else:
+        targets = np.array([[target_index[a], target_index[b]] for a, b in pairs])
+    if unseen_only:
+        seen = observed_pairs(data_handler)
+        targets = targets[[tuple(sorted(p)) not in seen for p in targets.tolist()]]
+    targets = targets.reshape(-1, 2)
+
+    # control population, optionally subsampled
+    ctrl_rows = np.flatnonzero((np.asarray(data_handler.ptb_codes) == -1).all(axis=1))
+    if n_ctrl is not None and n_ctrl < len(ctrl_rows):
+        rng = np.random.default_rng(seed)
+        ctrl_rows = np.sort(rng.choice(ctrl_rows, n_ctrl, replace=False))
+    x_ctrl = torch.from_numpy(data_handler.X[ctrl_rows].toarray())
+
+    torch.manual_seed(seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = load_model(savedir, device)
+    predictor = PairwisePredictor(model, x_ctrl, temp=temp, precision=precision)
+
+    outdir = os.path.join(savedir, "pairwise")
+    summary = predictor.predict_to_disk(targets, ptb_targets, outdir, chunk_rows=chunk_rows)
+    print(f"Predictions for {len(targets)} pairs saved to {outdir}")
+    return summary
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Predict double perturbations with a trained model.")
+    parser.add_argument(
+        "--savedir",
+        type=str,
+        default="./results/example",
+        help="Path to the saved model and config files.",
+    )
+    parser.add_argument(
+        "--pairs",
+        type=str,
+        default=None,
+        help="TSV file with two columns of target names (default: all pairs of targets)",
+    )
+    parser.add_argument(
+        "--unseen", action="store_true", help="Skip pairs observed in the dataset"
+    )
+    parser.add_argument(
+        "--n_ctrl", type=int, default=None, help="Number of control cells to use (default: all)"
+    )
+    parser.add_argument(
+        "--chunk_rows",
+        type=int,
+        default=1 << 16,
+        help="Number of decoded cells per chunk (pairs x control cells)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    pairs = None
+    if args.pairs is not None:
+        pairs = pd.read_csv(args.pairs, sep="\t", header=None).iloc[:, :2].values.tolist()
+
+    predict_pairs(
+        savedir=args.savedir,
+        pairs=pairs,
+        unseen_only=args.unseen,
+        n_ctrl=args.n_ctrl,
+        chunk_rows=args.chunk_rows,
+        seed=args.seed,
+    )
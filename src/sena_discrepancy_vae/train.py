@@ -1,14 +1,32 @@
 import os
-from collections import defaultdict
 from dataclasses import asdict
 import model as mod
 import numpy as np
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import Adam
 from tqdm import tqdm
-from utils import LossFunction
+from artifact import model_artifact, write_model_artifact
+from checkpoint import (
+    CHECKPOINT_FILE,
+    CHECKPOINT_VERSION,
+    CheckpointWriter,
+    load_loader_state,
+    loader_state,
+    rng_state,
+    set_rng_state,
+    snapshot,
+)
+from utils import BatchPrefetcher, LossFunction, autocast_context, precision_dtype
 import mlflow
 
+# Losses logged every epoch, in the order they are accumulated
+LOSS_NAMES = ["loss", "mmd_loss", "recon_loss", "kl_loss", "l1_loss"]
+
+# Options that may change when a run is resumed
+RUNTIME_OPTIONS = {"resume", "log", "mlflow_port", "num_workers", "persistent_workers", "pin_memory"}
+
 
 # Train CMVAE to data
 def train(
@@ -18,12 +36,39 @@ def train(
     savedir: str,
     logger,
     data_handler,
+    checkpoint=None,
 ) -> None:
+    """
+    Trains a CMVAE. After every epoch a checkpoint (model and optimizer
+    states, next epoch, best loss, RNG and loader states) is written to
+    savedir in the background; training continues from checkpoint, as
+    returned by checkpoint.load_checkpoint, if given.
+
+    With opts.distributed, every process of the initialized process group
+    trains on its shard of the batches (see Norman2019DataLoader num_replicas),
+    gradients are all-reduced by DistributedDataParallel and the epoch losses
+    are averaged over the batches of all processes. Only rank 0 logs to
+    mlflow and writes checkpoints.
+    """
+    rank = dist.get_rank() if opts.distributed else 0
+    log_mlflow = opts.log and rank == 0
 
-    if opts.log:
+    if checkpoint is not None:
+        changed = [
+            k
+            for k, v in asdict(opts).items()
+            if k not in RUNTIME_OPTIONS and checkpoint["opts"].get(k) != v
+        ]
+        if changed:
+            raise ValueError(f"Options differ from the checkpoint: {changed}")
+
+    if log_mlflow:
         logger.info(f"Starting mlflow server locally")
-        mlflow.start_run()
-        mlflow.log_params(asdict(opts))
+        if checkpoint is not None and checkpoint["mlflow_run_id"] is not None:
+            mlflow.start_run(run_id=checkpoint["mlflow_run_id"])
+        else:
+            mlflow.start_run()
+            mlflow.log_params(asdict(opts))
 
     logger.info(f"Started training on device: {device}")
 
@@ -39,14 +84,27 @@ def train(
             device=device,
             mode=opts.model,
             gos=data_handler.gos,
-            rel_dict=data_handler.rel_dict,
+            rel_dict=data_handler.gene_go_edges,
             sena_lambda=opts.sena_lambda,
+            sena_sparse=opts.sena_sparse,
         )
-        .double()
-        .to(device)
+        .to(device=device, dtype=precision_dtype(opts.precision))
     )
 
     optimizer = Adam(params=cmvae.parameters(), lr=opts.lr)
+    start_epoch = 0
+    min_train_loss = np.inf
+
+    if checkpoint is not None:
+        cmvae.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        start_epoch = checkpoint["epoch"]
+        min_train_loss = checkpoint["min_train_loss"]
+
+    # Replicas start from the parameters of rank 0 and all-reduce their gradients
+    model = (
+        DistributedDataParallel(cmvae, broadcast_buffers=False) if opts.distributed else cmvae
+    )
 
     cmvae.train()
     logger.info(f"Training for {opts.epochs} epochs...")
@@ -66,26 +124,54 @@ def train(
         [torch.ones(5), torch.linspace(1, opts.mxTemp, opts.epochs - 5)]
     )
 
-    min_train_loss = np.inf
-
     #init loss function class
-    loss_f = LossFunction(MMD_sigma=opts.MMD_sigma, kernel_num=opts.kernel_num, matched_IO=opts.matched_IO)
+    loss_f = LossFunction(
+        MMD_sigma=opts.MMD_sigma,
+        kernel_num=opts.kernel_num,
+        matched_IO=opts.matched_IO,
+        dtype=precision_dtype(opts.precision),
+    )
+
+    # Batches of several perturbations hold groups of batch_size cells, each scored on its own
+    group_size = opts.batch_size if opts.groups_per_batch > 1 else None
+
+    # Batches are fetched and copied to the device one step ahead
+    prefetcher = BatchPrefetcher(dataloader, device)
+
+    # Checkpoints are written by a background thread of rank 0
+    writer = CheckpointWriter() if rank == 0 else None
+
+    # Continue the random streams where the checkpointed epoch left them
+    if checkpoint is not None:
+        load_loader_state(dataloader, checkpoint["loader"])
+        set_rng_state(checkpoint["rng"])
+        logger.info(f"Resuming training at epoch {start_epoch + 1}")
 
     # Training loop
-    for epoch in range(opts.epochs):
-        epoch_losses = defaultdict(float)
+    for epoch in range(start_epoch, opts.epochs):
+        # Batch losses are summed on the device and read back once per epoch
+        loss_sums = torch.zeros(len(LOSS_NAMES), dtype=torch.float64, device=device)
+        num_batches = 0
+
+        # Draw fresh control cells for this epoch
+        if opts.ctrl_pairing == "epoch" and epoch > 0:
+            dataloader.dataset.resample_ctrl_pairing()
 
         # Using tqdm for progress bar during batch iteration
         for batch in tqdm(
-            dataloader, desc=f"Epoch {epoch + 1}/{opts.epochs}", unit="batch"
+            prefetcher,
+            desc=f"Epoch {epoch + 1}/{opts.epochs}",
+            unit="batch",
+            disable=rank != 0,
         ):
 
-            x, y, c = batch[0].to(device), batch[1].to(device), batch[2].to(device)
+            x, y, c = batch
 
             optimizer.zero_grad()
-            y_hat, x_recon, z_mu, z_var, G, bc = cmvae(
-                x, c, c, num_interv=1, temp=temp_schedule[epoch]
-            )
+            with autocast_context(opts.precision, device):
+                y_hat, x_recon, z_mu, z_var, G, bc = model(
+                    x, c, c, num_interv=1, temp=temp_schedule[epoch]
+                )
             mmd_loss, recon_loss, kl_loss, L1 = loss_f.compute_loss(
                 y_hat,
                 y,
@@ -93,7 +179,8 @@ def train(
                 x,
                 z_mu,
                 z_var,
-                G
+                G,
+                group_size=group_size,
             )
             loss = (
                 alpha_schedule[epoch] * mmd_loss
@@ -109,32 +196,63 @@ def train(
             optimizer.step()
 
             # Log batch losses
-            epoch_losses["loss"] += loss.item()
-            epoch_losses["mmd_loss"] += mmd_loss.item()
-            epoch_losses["recon_loss"] += recon_loss.item()
-            epoch_losses["kl_loss"] += kl_loss.item()
-            epoch_losses["l1_loss"] += L1.item()
+            loss_sums += torch.stack(
+                [t.detach().to(torch.float64) for t in (loss, mmd_loss, recon_loss, kl_loss, L1)]
+            )
+            num_batches += 1
 
-        # Log average epoch losses
-        for k in epoch_losses:
-            epoch_losses[k] /= len(dataloader)
+        # Log average epoch losses (over the batches processed by all ranks)
+        totals = torch.cat([loss_sums, loss_sums.new_tensor([num_batches])])
+        if opts.distributed:
+            dist.all_reduce(totals)
+        epoch_losses = dict(zip(LOSS_NAMES, (totals[:-1] / totals[-1]).tolist()))
 
-        if opts.log:
+        if log_mlflow:
             mlflow.log_metrics(
                 {f"avg_{k}": v for k, v in epoch_losses.items()}, step=epoch
             )
+            mlflow.log_metric("data_wait_s", prefetcher.wait_time, step=epoch)
 
         logger.info(
-            f"Epoch {epoch + 1}: Loss={epoch_losses['loss']:.6f}, MMD={epoch_losses['mmd_loss']:.6f}, MSE={epoch_losses['recon_loss']:.6f}, KL={epoch_losses['kl_loss']:.6f}, L1={epoch_losses['l1_loss']:.6f}"
+            f"Epoch {epoch + 1}: Loss={epoch_losses['loss']:.6f}, MMD={epoch_losses['mmd_loss']:.6f}, MSE={epoch_losses['recon_loss']:.6f}, KL={epoch_losses['kl_loss']:.6f}, L1={epoch_losses['l1_loss']:.6f}, data wait={prefetcher.wait_time:.2f}s"
         )
 
         # Save the best model
         current_loss = sum(epoch_losses.values()) / len(epoch_losses)
         if current_loss < min_train_loss:
             min_train_loss = current_loss
-            torch.save(cmvae, os.path.join(savedir, "best_model.pt"))
-            logger.info(f"Best model saved at epoch {epoch + 1}")
+            if writer is not None:
+                config, tensors = model_artifact(cmvae)
+                writer.submit(
+                    write_model_artifact,
+                    config,
+                    snapshot(tensors),
+                    os.path.join(savedir, "best_model"),
+                )
+                logger.info(f"Best model saved at epoch {epoch + 1}")
+
+        # Save the state needed to resume after this epoch
+        if writer is not None:
+            writer.save(
+                snapshot(
+                    {
+                        "version": CHECKPOINT_VERSION,
+                        "epoch": epoch + 1,
+                        "model": cmvae.state_dict(),
+                        "optimizer": optimizer.state_dict(),
+                        "min_train_loss": min_train_loss,
+                        "rng": rng_state(),
+                        "loader": loader_state(dataloader),
+                        "opts": asdict(opts),
+                        "mlflow_run_id": mlflow.active_run().info.run_id if log_mlflow else None,
+                    }
+                ),
+                os.path.join(savedir, CHECKPOINT_FILE),
+            )
+
+    if writer is not None:
+        writer.close()
 
-    if opts.log:
+    if log_mlflow:
         logger.info("Wrapping up mlflow server")
         mlflow.end_run()
@@ -1,44 +1,334 @@
+import contextlib
+import hashlib
+import json
+import math
 import os
-import random
+import shutil
+import time
 from collections import Counter, defaultdict
 from typing import Optional, Tuple
 import numpy as np
 import pandas as pd
 import scanpy as sc
+import scipy.sparse as sp
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader, Dataset, Sampler, Subset
+from torch.utils.data import DataLoader, Dataset, IterableDataset, Sampler, get_worker_info
 from torch.utils.data.sampler import Sampler
 
+# dtype of the weights and data for each precision mode ("bf16" keeps float32
+# master weights and runs the forward pass under bfloat16 autocast)
+PRECISION_DTYPES = {
+    "float64": torch.float64,
+    "float32": torch.float32,
+    "bf16": torch.float32,
+}
+
+
+def precision_dtype(precision: str) -> torch.dtype:
+    """Weight, data and loss dtype for the given precision mode."""
+    if precision not in PRECISION_DTYPES:
+        raise ValueError(
+            f"Invalid precision: {precision}. Expected one of {list(PRECISION_DTYPES)}."
+        )
+    return PRECISION_DTYPES[precision]
+
+
+def autocast_context(precision: str, device):
+    """Autocast context for the forward pass (a no-op unless precision is 'bf16')."""
+    if precision == "bf16":
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def encode_guide_ids(guide_ids, ptb_targets):
+    """
+    Parse a guide_ids column into integer perturbation codes. Each distinct
+    guide string is split only once.
+
+    Returns an (n_cells, max_targets) int64 array holding the index in
+    ptb_targets of each target of every cell. Unused slots are -1 (so control
+    cells are all -1) and targets missing from ptb_targets are -2.
+    """
+    guides = pd.Categorical(guide_ids)
+    target_index = {t: i for i, t in enumerate(ptb_targets)}
+    cat_targets = [c.split(",") if c != "" else [] for c in guides.categories.astype(str)]
+    max_targets = max([len(t) for t in cat_targets] + [1])
+
+    # the extra last row is selected by missing values (code -1)
+    cat_codes = np.full((len(cat_targets) + 1, max_targets), -1, dtype=np.int64)
+    for i, targets in enumerate(cat_targets):
+        cat_codes[i, : len(targets)] = [target_index.get(t, -2) for t in targets]
+
+    return cat_codes[guides.codes]
+
+
+def ptb_features(codes, num_targets):
+    """Multi-hot intervention features (n_cells, num_targets) from perturbation codes."""
+    rows, slots = np.nonzero(codes >= 0)
+    features = np.zeros((codes.shape[0], num_targets))
+    features[rows, codes[rows, slots]] = 1
+    return features
+
+
+# bump when the layout or content of the preprocessed dataset cache changes
+DATASET_CACHE_VERSION = 1
+
+# bump when the content of the split manifest of a run changes
+SPLIT_MANIFEST_VERSION = 1
+
+# digests of input files in the dataset cache, keyed by path, size and mtime
+FILE_DIGEST_INDEX = "file_digests.json"
+
+
+def file_digest(fpath, chunk_size=1 << 24):
+    """blake2b hex digest of a file's content."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_file_digest(fpath, cache_dir):
+    """
+    file_digest of fpath, reused from the digest index in cache_dir while the
+    size and modification time of the file are unchanged. The content is only
+    hashed on a mismatch (or if cache_dir is None).
+    """
+    if cache_dir is None:
+        return file_digest(fpath)
+
+    index_path = os.path.join(cache_dir, FILE_DIGEST_INDEX)
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+
+    key = os.path.abspath(fpath)
+    stat = os.stat(fpath)
+    entry = index.get(key)
+    if entry is not None and (entry["size"], entry["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+        return entry["digest"]
+
+    digest = file_digest(fpath)
+    index[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": digest}
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=4)
+    os.replace(tmp_path, index_path)
+    return digest
+
+
+class BackedRows:
+    """
+    Rows of the X matrix of an h5ad file opened in backed mode, so that only
+    the requested rows are ever read into memory. rows optionally restricts
+    (and renumbers) the rows of the file that are exposed.
+
+    Indexing with an int or an array of row indices returns a CSR matrix.
+    Pickling keeps only the file name; the file is reopened on unpickling
+    (e.g. in DataLoader workers).
+    """
+
+    def __init__(self, fpath, rows=None):
+        self.fpath = fpath
+        self.rows = rows
+        self.open()
+
+    def open(self):
+        self.adata = sc.read_h5ad(self.fpath, backed="r")
+        n_rows = self.adata.shape[0] if self.rows is None else len(self.rows)
+        self.shape = (n_rows, self.adata.shape[1])
+
+    def __getitem__(self, item):
+        item = np.atleast_1d(item)
+        if self.rows is not None:
+            item = self.rows[item]
+        # h5py reads need increasing, unique indices
+        uniq, inverse = np.unique(item, return_inverse=True)
+        X = self.adata.X[uniq]
+        X = sp.csr_matrix(X) if sp.issparse(X) else sp.csr_matrix(np.asarray(X))
+        return X[inverse]
+
+    def __getstate__(self):
+        return {"fpath": self.fpath, "rows": self.rows}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
 
 class Norman2019DataLoader:
     def __init__(
-        self, num_gene_th=5, batch_size=32, dataname="Norman2019_raw"
+        self,
+        num_gene_th=5,
+        batch_size=32,
+        dataname="Norman2019_raw",
+        cache_dir=os.path.join("data", "cache"),
+        dtype=torch.float64,
+        resident_device=None,
+        ctrl_pairing="fixed",
+        seed=None,
+        backed=False,
+        stream_buffer_size=16384,
+        num_workers=0,
+        persistent_workers=False,
+        pin_memory=False,
+        intervention_encoding="onehot",
+        groups_per_batch=1,
+        num_replicas=1,
+        rank=0,
     ):
+        if backed and resident_device is not None:
+            raise ValueError("backed and resident_device cannot be used together")
+        if backed and num_replicas > 1:
+            # ranks must run the same number of steps, which streaming cannot guarantee
+            raise ValueError("backed cannot be used with num_replicas > 1")
+        if persistent_workers and ctrl_pairing == "epoch":
+            # persistent workers would keep using the pairing of the first epoch
+            raise ValueError("persistent_workers cannot be used with ctrl_pairing='epoch'")
+
         self.num_gene_th = num_gene_th
         self.batch_size = batch_size
+        self.dtype = dtype
+        self.resident_device = resident_device
+        self.ctrl_pairing = ctrl_pairing
+        self.seed = seed
+        self.backed = backed
+        self.stream_buffer_size = stream_buffer_size
+        self.num_workers = num_workers
+        self.persistent_workers = persistent_workers
+        self.pin_memory = pin_memory
+        self.intervention_encoding = intervention_encoding
+        self.groups_per_batch = groups_per_batch
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.dataname = dataname
         self.datafile = os.path.join('data',f"{dataname}.h5ad")
+        self.cache_dir = cache_dir
 
         # Initialize variables
-        self.adata = None
-        self.double_adata = None
+        self.X = None
+        self.ptb_codes = None
+        self.guide_ids = None
+        self.genes = None
+        self.fingerprint = None
         self.ptb_targets = None
         self.ptb_targets_affected = None
         self.gos = None
         self.rel_dict = None
+        self.gene_go_edges = None
         self.gene_go_dict = None
         self.ensembl_genename_mapping_rev = None
 
+        # Split of the single-perturbation cells, set by get_data
+        self.test_idx = None
+
         # Load the dataset
         self.load_norman_2019_dataset()
 
+    @classmethod
+    def from_split_manifest(cls, manifest, **kwargs):
+        """
+        Rebuilds the loader that wrote manifest (see split_manifest), with the
+        same split, batch sizes and control pairing. kwargs are passed to the
+        constructor (e.g. dtype, backed, cache_dir).
+        """
+        if manifest["version"] != SPLIT_MANIFEST_VERSION:
+            raise ValueError(f"Unsupported split manifest version: {manifest['version']}")
+
+        loader = cls(
+            num_gene_th=manifest["num_gene_th"],
+            batch_size=manifest["batch_size"],
+            groups_per_batch=manifest.get("groups_per_batch", 1),
+            dataname=manifest["dataname"],
+            ctrl_pairing=manifest["ctrl_pairing"],
+            seed=manifest["seed"],
+            **kwargs,
+        )
+        if loader.fingerprint != manifest["fingerprint"]:
+            raise ValueError(
+                f"Dataset {manifest['dataname']} changed since the split manifest was written"
+            )
+        if list(loader.ptb_targets) != manifest["ptb_targets"]:
+            raise ValueError("Perturbation targets differ from the split manifest")
+
+        loader.test_idx = np.asarray(manifest["test_idx"], dtype=np.int64)
+        return loader
+
+    def split_manifest(self):
+        """
+        Compact description of the folds built by get_data: the dataset
+        fingerprint, the left-out single-perturbation cells (the training fold
+        is their complement), the control pairing seed and the perturbation
+        order. The double fold holds all combinatorial cells.
+        """
+        if self.test_idx is None:
+            raise ValueError("get_data(mode='train') must be called first")
+        return {
+            "version": SPLIT_MANIFEST_VERSION,
+            "fingerprint": self.fingerprint,
+            "dataname": self.dataname,
+            "num_gene_th": self.num_gene_th,
+            "batch_size": self.batch_size,
+            "groups_per_batch": self.groups_per_batch,
+            "ctrl_pairing": self.ctrl_pairing,
+            "seed": self.seed,
+            "ptb_targets": list(self.ptb_targets),
+            "test_idx": self.test_idx.tolist(),
+        }
+
+    def fold_loader(self, fold):
+        """Loader of the 'train', 'test' or 'double' fold of the current split."""
+        assert fold in ["train", "test", "double"], "fold not supported!"
+        if fold == "double":
+            return self.get_data(mode="test", perturb_targets=self.ptb_targets)[0]
+        dataloader, dataloader2, _, _, _ = self.get_data(mode="train", test_idx=self.test_idx)
+        return dataloader if fold == "train" else dataloader2
+
     def load_norman_2019_dataset(self):
+        """
+        Loads the preprocessed dataset: all single, control and combinatorial
+        cells as one CSR matrix X, with their perturbation codes and guide ids.
+        The arrays are memory-mapped from the on-disk cache if it holds an
+        artifact for the same input files and parameters, otherwise they are
+        computed from the h5ad file and written to the cache.
+
+        With backed=True, X is a BackedRows view of the h5ad file instead: only
+        the perturbation codes and guide ids are held in memory, and nothing is
+        cached.
+        """
+        self.fingerprint = self.dataset_fingerprint()
+        cache_path = None if self.backed else self.dataset_cache_path()
+
+        if cache_path is not None and os.path.exists(cache_path):
+            self.load_cached_dataset(cache_path)
+        else:
+            self.preprocess_norman_2019_dataset()
+            if cache_path is not None:
+                self.save_cached_dataset(cache_path)
+
+        self.rel_dict = defaultdict(list)
+        for gen, go in zip(*self.gene_go_edges.tolist()):
+            self.rel_dict[gen].append(go)
+
+    def preprocess_norman_2019_dataset(self):
         # Define file path
         fpath = self.datafile
 
-        # Keep only single interventions
-        adata = sc.read_h5ad(fpath)
-        adata = adata[(~adata.obs["guide_ids"].str.contains(","))]
+        # Read the file once and parse guide_ids into perturbation codes
+        # against the single-target perturbations present in the data
+        adata_full = sc.read_h5ad(fpath, backed="r" if self.backed else None)
+        guides = adata_full.obs["guide_ids"].astype("category")
+        present = guides.cat.categories[np.unique(guides.cat.codes[guides.cat.codes >= 0])]
+        ptb_targets = sorted(present[(present != "") & ~present.str.contains(",")])
+        codes = encode_guide_ids(guides, ptb_targets)
+        n_targets = (codes != -1).sum(axis=1)
+
+        # Keep only single interventions (and controls)
+        adata = adata_full[n_targets <= 1]
 
         # Build gene sets
         gos, GO_to_ensembl_id_assignment, gene_go_dict = self.load_gene_go_assignments(
@@ -51,32 +341,119 @@ class Norman2019DataLoader:
         )
 
         # Build gene-GO relationships
-        rel_dict = self.build_gene_go_relationships(
-            adata, gos, GO_to_ensembl_id_assignment
-        )
+        gene_go_edges = self.load_gene_go_edges(adata, gos, GO_to_ensembl_id_assignment)
 
-        # Load double perturbation data
-        ptb_targets = sorted(adata.obs["guide_ids"].unique().tolist())[1:]
-        double_adata = sc.read_h5ad(fpath).copy()
-        double_adata = double_adata[
-            (double_adata.obs["guide_ids"].str.contains(","))
-            & (
-                double_adata.obs["guide_ids"].map(
-                    lambda x: all([y in ptb_targets for y in x.split(",")])
-                )
-            )
-        ]
+        # Combinatorial perturbations whose targets are all single perturbations
+        double = (n_targets >= 2) & ((codes >= 0) | (codes == -1)).all(axis=1)
+        keep = (n_targets <= 1) | double
 
         # Assign instance variables
-        self.adata = adata
-        self.double_adata = double_adata
+        if self.backed:
+            self.X = BackedRows(fpath, rows=np.flatnonzero(keep))
+            adata_full.file.close()
+        else:
+            self.X = sp.csr_matrix(adata_full.X[keep])
+        self.ptb_codes = codes[keep]
+        self.guide_ids = pd.Categorical(guides.values[keep])
+        self.genes = adata_full.var_names.values
         self.ptb_targets = ptb_targets
         self.ptb_targets_affected = ptb_targets_affected
         self.gos = gos
-        self.rel_dict = rel_dict
+        self.gene_go_edges = gene_go_edges
         self.gene_go_dict = gene_go_dict
         self.ensembl_genename_mapping_rev = ensembl_genename_mapping_rev
 
+    def dataset_fingerprint(self):
+        """
+        Identifies the preprocessed dataset: a hash of the cache version, the
+        loader parameters and the content of every input file (see
+        cached_file_digest).
+        """
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(
+            json.dumps(
+                {"version": DATASET_CACHE_VERSION, "num_gene_th": self.num_gene_th}
+            ).encode()
+        )
+        for fpath in [
+            self.datafile,
+            os.path.join("data", "go_kegg_gene_map.tsv"),
+            os.path.join("data", "topGO_uhler.tsv"),
+            os.path.join("data", "ensembl_genename_mapping.tsv"),
+        ]:
+            digest.update(cached_file_digest(fpath, self.cache_dir).encode())
+        return digest.hexdigest()
+
+    def dataset_cache_path(self):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, f"{self.dataname}_{self.fingerprint}")
+
+    def save_cached_dataset(self, cache_path):
+        """Writes the preprocessed arrays as .npy files plus a JSON manifest."""
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+
+        arrays = {
+            "X_data": self.X.data,
+            "X_indices": self.X.indices,
+            "X_indptr": self.X.indptr,
+            "ptb_codes": self.ptb_codes,
+            "guide_codes": self.guide_ids.codes,
+            "gene_go_edges": self.gene_go_edges,
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+
+        manifest = {
+            "version": DATASET_CACHE_VERSION,
+            "fingerprint": self.fingerprint,
+            "shape": list(self.X.shape),
+            "genes": list(self.genes),
+            "guide_categories": list(self.guide_ids.categories),
+            "ptb_targets": list(self.ptb_targets),
+            "ptb_targets_affected": list(self.ptb_targets_affected),
+            "gos": list(self.gos),
+            "gene_go_dict": dict(self.gene_go_dict),
+            "ensembl_genename_mapping_rev": self.ensembl_genename_mapping_rev,
+        }
+        with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+
+        # publish atomically; if a concurrent run got there first, keep its copy
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            shutil.rmtree(tmp_path)
+
+    def load_cached_dataset(self, cache_path):
+        """Memory-maps the preprocessed arrays written by save_cached_dataset."""
+        with open(os.path.join(cache_path, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        if manifest["version"] != DATASET_CACHE_VERSION:
+            raise ValueError(f"Unsupported dataset cache version in {cache_path}")
+
+        def load(name):
+            return np.load(os.path.join(cache_path, f"{name}.npy"), mmap_mode="r")
+
+        self.X = sp.csr_matrix(
+            (load("X_data"), load("X_indices"), load("X_indptr")),
+            shape=tuple(manifest["shape"]),
+            copy=False,
+        )
+        self.ptb_codes = load("ptb_codes")
+        self.guide_ids = pd.Categorical.from_codes(
+            load("guide_codes"), categories=manifest["guide_categories"]
+        )
+        self.genes = np.array(manifest["genes"], dtype=object)
+        self.ptb_targets = manifest["ptb_targets"]
+        self.ptb_targets_affected = manifest["ptb_targets_affected"]
+        self.gos = manifest["gos"]
+        # small and turned into tensors by the model, so read into (writable) memory
+        self.gene_go_edges = np.array(load("gene_go_edges"))
+        self.gene_go_dict = defaultdict(list, manifest["gene_go_dict"])
+        self.ensembl_genename_mapping_rev = manifest["ensembl_genename_mapping_rev"]
+
     def load_gene_go_assignments(self, adata):
         # Filter genes not in any GO
         GO_to_ensembl_id_assignment = pd.read_csv(
@@ -145,7 +522,11 @@ class Norman2019DataLoader:
         )
         ptb_targets = list(
             set(intervention_genenames).intersection(
-                set([x for x in adata.obs["guide_ids"] if x != "" and "," not in x])
+                set(
+                    x
+                    for x in adata.obs["guide_ids"].unique()
+                    if x != "" and "," not in x
+                )
             )
         )
         ptb_targets_ens = list(
@@ -155,70 +536,103 @@ class Norman2019DataLoader:
         return ptb_targets, ptb_targets_ens, ensembl_genename_mapping_rev
 
     def build_gene_go_relationships(self, adata, gos, GO_to_ensembl_id_assignment):
-        # Get genes
-        genes = adata.var.index.values
-        go_dict = dict(zip(gos, range(len(gos))))
-        gen_dict = dict(zip(genes, range(len(genes))))
-        rel_dict = defaultdict(list)
-        gene_set, go_set = set(genes), set(gos)
-
-        for go, gen in zip(
-            GO_to_ensembl_id_assignment["GO_id"],
-            GO_to_ensembl_id_assignment["ensembl_id"],
-        ):
-            if (gen in gene_set) and (go in go_set):
-                rel_dict[gen_dict[gen]].append(go_dict[go])
+        """
+        Returns a (2, nnz) int64 array of (gene index, GO index) edges, in the
+        order of the GO assignment table.
+        """
+        # Get genes (last occurrence wins for duplicated names)
+        genes = pd.Series(np.arange(len(adata.var.index)), index=adata.var.index.values)
+        genes = genes[~genes.index.duplicated(keep="last")]
+        gos = pd.Series(np.arange(len(gos)), index=gos)
+
+        gen_idx = genes.reindex(GO_to_ensembl_id_assignment["ensembl_id"].values).values
+        go_idx = gos.reindex(GO_to_ensembl_id_assignment["GO_id"].values).values
+        keep = ~(np.isnan(gen_idx) | np.isnan(go_idx))
 
-        return rel_dict
+        return np.stack([gen_idx[keep], go_idx[keep]]).astype(np.int64)
 
-    def get_data(self, mode="train", perturb_targets=None):
+    def load_gene_go_edges(self, adata, gos, GO_to_ensembl_id_assignment):
+        """
+        Gene-GO edges from the on-disk cache, keyed by the gene list, the GO list
+        and num_gene_th. Built and cached on a miss (or if cache_dir is None).
+        """
+        if self.cache_dir is None:
+            return self.build_gene_go_relationships(adata, gos, GO_to_ensembl_id_assignment)
+
+        key = hashlib.sha256(
+            "\n".join(
+                ["\t".join(adata.var.index.values), "\t".join(gos), str(self.num_gene_th)]
+            ).encode()
+        ).hexdigest()[:16]
+        fpath = os.path.join(self.cache_dir, f"gene_go_edges_{key}.npy")
+
+        if os.path.exists(fpath):
+            return np.load(fpath)
+
+        gene_go_edges = self.build_gene_go_relationships(
+            adata, gos, GO_to_ensembl_id_assignment
+        )
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{fpath}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, gene_go_edges)
+        os.replace(tmp_path, fpath)
+        return gene_go_edges
+
+    def get_data(self, mode="train", perturb_targets=None, test_idx=None):
+        """
+        mode="train" returns the training and left-out loaders of the single
+        perturbations, split by split_scdata unless test_idx (the left-out
+        cells) is given. mode="test" returns the loader of the combinatorial
+        perturbations of perturb_targets.
+        """
         assert mode in ["train", "test"], "mode not supported!"
 
         if mode == "train":
             dataset = SCDataset(
-                adata=self.adata,
-                double_adata=self.double_adata,
+                X=self.X,
+                ptb_codes=self.ptb_codes,
+                guide_ids=self.guide_ids,
                 ptb_targets=self.ptb_targets,
                 perturb_type="single",
                 perturb_targets=perturb_targets,
+                dtype=self.dtype,
+                ctrl_pairing=self.ctrl_pairing,
+                seed=self.seed,
+                intervention_encoding=self.intervention_encoding,
             )
-            train_idx, test_idx = self.split_scdata(
-                dataset,
-                split_ptbs=[
-                    "ETS2",
-                    "SGK1",
-                    "POU3F2",
-                    "TBX2",
-                    "CBL",
-                    "MAPK1",
-                    "CDKN1C",
-                    "S1PR2",
-                    "PTPN1",
-                    "MAP2K6",
-                    "COL1A1",
-                ],
-            )  # Leave out some cells from the top 12 single target-gene interventions
+            if test_idx is None:
+                train_idx, test_idx = self.split_scdata(
+                    dataset,
+                    split_ptbs=[
+                        "ETS2",
+                        "SGK1",
+                        "POU3F2",
+                        "TBX2",
+                        "CBL",
+                        "MAPK1",
+                        "CDKN1C",
+                        "S1PR2",
+                        "PTPN1",
+                        "MAP2K6",
+                        "COL1A1",
+                    ],
+                )  # Leave out some cells from the top 12 single target-gene interventions
+            else:
+                is_test = np.zeros(len(dataset), dtype=bool)
+                is_test[test_idx] = True
+                train_idx = np.flatnonzero(~is_test)
+            self.test_idx = np.asarray(test_idx, dtype=np.int64)
 
             ptb_genes = dataset.ptb_targets
+            loader = self.make_loader(dataset)
 
-            dataset1 = Subset(dataset, train_idx)
-            ptb_name = dataset.ptb_names[train_idx]
-            dataloader = DataLoader(
-                dataset1,
-                batch_sampler=SCDATA_sampler(dataset1, self.batch_size, ptb_name),
-                num_workers=0,
-            )
+            dataloader = loader(self.batch_size, train_idx, training=True)
 
             dim = dataset[0][0].shape[0]
-            cdim = dataset[0][2].shape[0]
-
-            dataset2 = Subset(dataset, test_idx)
-            ptb_name = dataset.ptb_names[test_idx]
-            dataloader2 = DataLoader(
-                dataset2,
-                batch_sampler=SCDATA_sampler(dataset2, 8, ptb_name),
-                num_workers=0,
-            )
+            cdim = len(dataset.ptb_targets)
+
+            dataloader2 = loader(8, test_idx)
 
             return dataloader, dataloader2, dim, cdim, ptb_genes
 
@@ -227,147 +641,670 @@ class Norman2019DataLoader:
                 perturb_targets is not None
             ), "perturb_targets has to be specified during testing!"
             dataset = SCDataset(
-                adata=self.adata,
-                double_adata=self.double_adata,
+                X=self.X,
+                ptb_codes=self.ptb_codes,
+                guide_ids=self.guide_ids,
                 ptb_targets=self.ptb_targets,
                 perturb_type="double",
                 perturb_targets=perturb_targets,
+                dtype=self.dtype,
+                ctrl_pairing=self.ctrl_pairing,
+                seed=self.seed,
+                intervention_encoding=self.intervention_encoding,
             )
             ptb_genes = dataset.ptb_targets
 
-            dataloader = DataLoader(
-                dataset,
-                batch_sampler=SCDATA_sampler(dataset, self.batch_size),
-                num_workers=0,
-            )
+            dataloader = self.make_loader(dataset)(self.batch_size)
 
             dim = dataset[0][0].shape[0]
-            cdim = dataset[0][2].shape[0]
+            cdim = len(dataset.ptb_targets)
 
             return dataloader, dim, cdim, ptb_genes
 
+    def make_loader(self, dataset):
+        """
+        Returns a function (batchsize, indices=None, training=False) that
+        builds a loader of single-perturbation batches over dataset
+        (restricted to indices): a device-resident loader if resident_device
+        is set, a streaming loader if the data is backed, otherwise a
+        DataLoader over an SCDATA_sampler. Training loaders concatenate
+        groups_per_batch such batches and, with num_replicas > 1, only yield
+        the shard of this rank.
+        """
+        def sampler(batchsize, indices, training):
+            ptb_name = None if indices is None else dataset.ptb_names[indices]
+            return SCDATA_sampler(
+                dataset,
+                batchsize,
+                ptb_name,
+                indices=indices,
+                seed=self.seed,
+                num_replicas=self.num_replicas if training else 1,
+                rank=self.rank if training else 0,
+                groups_per_batch=self.groups_per_batch if training else 1,
+            )
+
+        if self.resident_device is not None:
+            resident = ResidentSCDataset(dataset, self.resident_device)
+            return lambda batchsize, indices=None, training=False: ResidentDataLoader(
+                resident, sampler(batchsize, indices, training)
+            )
+
+        # batches are built whole by the dataset (batch_size=None disables
+        # collation), in worker processes if num_workers > 0
+        loader_kwargs = dict(
+            batch_size=None,
+            num_workers=self.num_workers,
+            persistent_workers=self.persistent_workers and self.num_workers > 0,
+            pin_memory=self.pin_memory,
+            worker_init_fn=seed_worker if self.num_workers > 0 else None,
+        )
+
+        if self.backed:
+            return lambda batchsize, indices=None, training=False: DataLoader(
+                StreamingSCDataset(
+                    dataset,
+                    batchsize,
+                    indices=indices,
+                    chunk_size=max(self.stream_buffer_size // 16, 1),
+                    buffer_size=self.stream_buffer_size,
+                    seed=self.seed,
+                    groups_per_batch=self.groups_per_batch if training else 1,
+                ),
+                **loader_kwargs,
+            )
+
+        # the sampler yields whole batches of dataset indices, which SCDataset
+        # fetches with a single CSR slice
+        return lambda batchsize, indices=None, training=False: DataLoader(
+            dataset, sampler=sampler(batchsize, indices, training), **loader_kwargs
+        )
+
     def split_scdata(self, scdataset, split_ptbs, pct=0.2):
+        """
+        Leaves out pct of the cells of each perturbation in split_ptbs. If the
+        loader has a seed, the split is drawn from its own generator and kept
+        in the dataset cache, otherwise numpy's global RNG is used.
+        """
+        split_path = self.split_cache_path(split_ptbs, pct)
+        if split_path is not None and os.path.exists(split_path):
+            split = np.load(split_path)
+            return split["train_idx"], split["test_idx"]
+
         # Split data into training and testing
+        rng = np.random if self.seed is None else np.random.default_rng(self.seed)
         test_idx = []
         for ptb in split_ptbs:
             idx = np.where(scdataset.ptb_names == ptb)[0]
-            test_idx.append(np.random.choice(idx, int(len(idx) * pct), replace=False))
+            test_idx.append(rng.choice(idx, int(len(idx) * pct), replace=False))
         test_idx = np.hstack(test_idx)
-        train_idx = np.array([l for l in range(len(scdataset)) if l not in test_idx])
+        is_test = np.zeros(len(scdataset), dtype=bool)
+        is_test[test_idx] = True
+        train_idx = np.flatnonzero(~is_test)
+
+        if split_path is not None:
+            tmp_path = f"{split_path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp_path, train_idx=train_idx, test_idx=test_idx)
+            os.replace(tmp_path, split_path)
         return train_idx, test_idx
 
+    def split_cache_path(self, split_ptbs, pct):
+        cache_path = self.dataset_cache_path()
+        if self.seed is None or cache_path is None or not os.path.isdir(cache_path):
+            return None
+        key = hashlib.blake2b(
+            json.dumps({"seed": self.seed, "pct": pct, "split_ptbs": split_ptbs}).encode(),
+            digest_size=8,
+        ).hexdigest()
+        return os.path.join(cache_path, f"split_{key}.npz")
+
 class SCDataset(Dataset):
     def __init__(
         self,
-        adata,
-        double_adata,
+        X,
+        ptb_codes,
+        guide_ids,
         ptb_targets,
         perturb_type="single",
         perturb_targets=None,
+        dtype=torch.float64,
+        ctrl_pairing="fixed",
+        seed=None,
+        intervention_encoding="onehot",
     ):
+        """
+        Perturbed cells of X (single or combinatorial, selected with ptb_codes,
+        see encode_guide_ids) paired with control cells of X. Rows are
+        referenced by index, so X (possibly memory-mapped, or a BackedRows
+        view of a file) is never copied.
+
+        ctrl_pairing controls how a control cell is paired with each perturbed cell:
+        "fixed" draws the pairing once, "epoch" redraws it on every call to
+        resample_ctrl_pairing (once per epoch during training) and "batch" draws
+        fresh controls on every fetch. Draws come from a generator seeded with
+        seed, or from numpy's global RNG if seed is None.
+
+        intervention_encoding selects how interventions are returned: "onehot"
+        as (num_targets,) multi-hot vectors of dtype, "index" as the int64
+        target indices of the cell padded with -1 (see CMVAE.c_encode).
+        """
         super().__init__()
         assert perturb_type in ["single", "double"], "perturb_type not supported!"
+        assert ctrl_pairing in ["fixed", "epoch", "batch"], "ctrl_pairing not supported!"
+        assert intervention_encoding in ["onehot", "index"], "intervention_encoding not supported!"
 
-        self.genes = adata.var.index.tolist()
+        self.dtype = dtype
+        self.intervention_encoding = intervention_encoding
+        self.ctrl_pairing_mode = ctrl_pairing
+        self.seed = seed
+        self.rng = np.random if seed is None else np.random.default_rng(seed)
+
+        self.X = X
         self.ptb_targets = ptb_targets
 
+        n_targets = (ptb_codes != -1).sum(axis=1)
+
         if perturb_type == "single":
-            ptb_adata = adata[
-                (~adata.obs["guide_ids"].str.contains(","))
-                & (adata.obs["guide_ids"] != "")
-            ].copy()
-
-            # Keep only cells containing perturbed genes
-            ptb_adata = ptb_adata[ptb_adata.obs["guide_ids"].isin(ptb_targets), :]
-
-            self.ptb_samples = ptb_adata.X
-            self.ptb_names = ptb_adata.obs["guide_ids"].values
-            self.ptb_ids = self.map_ptb_features(
-                self.ptb_targets, ptb_adata.obs["guide_ids"].values
-            )
+            # Keep only cells containing a single perturbed gene
+            keep = (n_targets == 1) & (ptb_codes[:, 0] >= 0)
 
         elif perturb_type == "double":
-            ptb_adata = double_adata[
-                (double_adata.obs["guide_ids"].str.contains(","))
-                & (double_adata.obs["guide_ids"] != "")
-            ].copy()
-
-            # Keep only cells containing perturbed genes
-            ptb_adata = ptb_adata[
-                ptb_adata.obs["guide_ids"].apply(
-                    lambda x: all([y in ptb_targets for y in x.split(",")])
-                ),
-                :,
-            ]
+            # Keep only cells whose perturbed genes are all known targets
+            keep = (n_targets >= 2) & ((ptb_codes >= 0) | (ptb_codes == -1)).all(axis=1)
+
+        self.ptb_rows = np.flatnonzero(keep)
+        self.ptb_names = np.asarray(guide_ids[self.ptb_rows], dtype=object)
+        self.ptb_codes = np.asarray(ptb_codes[self.ptb_rows])
+
+        # Only the control pool is stored; perturbed cells point into it
+        self.ctrl_rows = np.flatnonzero(n_targets == 0)
+        self.resample_ctrl_pairing()
+
+    @property
+    def ptb_samples(self):
+        return self.X[self.ptb_rows]
+
+    @property
+    def ctrl_samples(self):
+        return self.X[self.ctrl_rows]
+
+    @property
+    def ptb_ids(self):
+        return self.interventions(self.ptb_codes)
+
+    def interventions(self, codes):
+        """Intervention tensor of the given perturbation codes, see intervention_encoding."""
+        if self.intervention_encoding == "index":
+            return torch.from_numpy(np.array(codes, dtype=np.int64))
+        return torch.from_numpy(ptb_features(codes, len(self.ptb_targets))).to(self.dtype)
+
+    def resample_ctrl_pairing(self):
+        """Draw a new control cell (index into ctrl_rows) for every perturbed cell."""
+        self.ctrl_pairing = self.rng.choice(
+            len(self.ctrl_rows), len(self.ptb_rows), replace=True
+        )
 
-            self.ptb_samples = ptb_adata.X
-            self.ptb_names = ptb_adata.obs["guide_ids"].values
-            self.ptb_ids = self.map_ptb_features(
-                self.ptb_targets, ptb_adata.obs["guide_ids"].values
-            )
+    def state_dict(self):
+        """Control pairing and generator state (numpy's global RNG is not included)."""
+        rng_state = None if self.rng is np.random else self.rng.bit_generator.state
+        return {"ctrl_pairing": self.ctrl_pairing, "rng": rng_state}
 
-        self.ctrl_samples = adata[adata.obs["guide_ids"] == ""].X.copy()
-        self.rand_ctrl_samples = self.ctrl_samples[
-            np.random.choice(
-                self.ctrl_samples.shape[0], self.ptb_samples.shape[0], replace=True
-            )
-        ]
+    def load_state_dict(self, state):
+        self.ctrl_pairing = state["ctrl_pairing"]
+        if state["rng"] is not None:
+            self.rng.bit_generator.state = state["rng"]
 
     def __getitem__(self, item):
-        x = torch.from_numpy(
-            self.rand_ctrl_samples[item].toarray().flatten()
-        ).double()
-        y = torch.from_numpy(self.ptb_samples[item].toarray().flatten()).double()
-        c = torch.from_numpy(self.ptb_ids[item]).double()
+        # item is either a single index or a list of indices forming a whole
+        # batch, in which case the CSR rows are sliced and densified at once
+        if self.ctrl_pairing_mode == "batch":
+            ctrl_item = self.rng.choice(len(self.ctrl_rows), np.shape(item) or None)
+        else:
+            ctrl_item = self.ctrl_pairing[item]
+        x = self.X[self.ctrl_rows[ctrl_item]].toarray()
+        y = self.X[self.ptb_rows[item]].toarray()
+        c = self.interventions(self.ptb_codes[np.atleast_1d(item)])
+        if np.ndim(item) == 0:
+            x, y, c = x.flatten(), y.flatten(), c.flatten()
+        x = torch.from_numpy(x).to(self.dtype)
+        y = torch.from_numpy(y).to(self.dtype)
         return x, y, c
 
     def __len__(self):
-        return self.ptb_samples.shape[0]
+        return len(self.ptb_rows)
 
     def map_ptb_features(self, all_ptb_targets, ptb_ids):
-        ptb_features = []
-        for id in ptb_ids:
-            feature = np.zeros(len(all_ptb_targets))
-            feature[[all_ptb_targets.index(i) for i in id.split(",")]] = 1
-            ptb_features.append(feature)
-        return np.vstack(ptb_features)
+        codes = encode_guide_ids(ptb_ids, all_ptb_targets)
+        if (codes == -2).any():
+            raise ValueError("ptb_ids contain targets missing from all_ptb_targets")
+        return ptb_features(codes, len(all_ptb_targets))
+
+class ResidentSCDataset:
+    """
+    Copy of an SCDataset held in contiguous tensors on the training device:
+    perturbed samples, the control pool, the control pairing and the
+    intervention features. Batches are gathered from index tensors on the
+    device, with no host work or host-to-device copies.
+    """
+
+    def __init__(self, scdataset, device):
+        self.device = torch.device(device)
+        self.dtype = scdataset.dtype
+        self.ptb_names = scdataset.ptb_names
+        self.ptb_samples = self.to_device(scdataset.ptb_samples.toarray())
+        self.ctrl_samples = self.to_device(scdataset.ctrl_samples.toarray())
+        self.ptb_ids = scdataset.ptb_ids.to(self.device)
+        if self.ptb_ids.is_floating_point():
+            self.ptb_ids = self.ptb_ids.to(self.dtype)
+        self.ctrl_pairing = torch.as_tensor(
+            scdataset.ctrl_pairing, dtype=torch.long, device=self.device
+        )
+        self.ctrl_pairing_mode = scdataset.ctrl_pairing_mode
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(
+            scdataset.seed if scdataset.seed is not None else np.random.randint(2**31 - 1)
+        )
+
+    def resample_ctrl_pairing(self):
+        """Draw a new control cell for every perturbed cell, on the device."""
+        self.ctrl_pairing = self.draw_ctrl(self.ctrl_pairing.shape[0])
+
+    def state_dict(self):
+        return {"ctrl_pairing": self.ctrl_pairing, "generator": self.generator.get_state()}
+
+    def load_state_dict(self, state):
+        self.ctrl_pairing = state["ctrl_pairing"].to(self.device)
+        self.generator.set_state(state["generator"])
+
+    def draw_ctrl(self, n):
+        return torch.randint(
+            self.ctrl_samples.shape[0], (n,), generator=self.generator, device=self.device
+        )
+
+    def to_device(self, array):
+        return torch.as_tensor(array).to(device=self.device, dtype=self.dtype).contiguous()
+
+    def __getitem__(self, item):
+        item = torch.as_tensor(item, dtype=torch.long, device=self.device)
+        if self.ctrl_pairing_mode == "batch":
+            ctrl_item = self.draw_ctrl(item.numel())
+        else:
+            ctrl_item = self.ctrl_pairing[item].reshape(-1)
+        x = self.ctrl_samples.index_select(0, ctrl_item)
+        y = self.ptb_samples.index_select(0, item)
+        c = self.ptb_ids.index_select(0, item)
+        return x, y, c
+
+    def __len__(self):
+        return self.ptb_samples.shape[0]
+
+
+class ResidentDataLoader:
+    """
+    Iterates the batches planned by an SCDATA_sampler over a ResidentSCDataset.
+    The epoch's plan is moved to the device once as an index tensor.
+    """
+
+    def __init__(self, dataset, sampler):
+        self.dataset = dataset
+        self.sampler = sampler
+
+    def __iter__(self):
+        plan = torch.as_tensor(
+            self.sampler.epoch_plan(), dtype=torch.long, device=self.dataset.device
+        )
+        for batch in plan:
+            yield self.dataset[batch]
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+def seed_worker(worker_id):
+    """
+    DataLoader worker_init_fn: reopens backed files in the worker and gives
+    each worker its own stream of control draws, derived from the dataset
+    seed and the worker seed (itself drawn from torch's seeded global RNG).
+    """
+    info = get_worker_info()
+    dataset = info.dataset
+    scdataset = getattr(dataset, "dataset", dataset)
+    if isinstance(scdataset.X, BackedRows):
+        scdataset.X.open()
+    if isinstance(dataset, SCDataset) and dataset.seed is not None:
+        dataset.rng = np.random.default_rng([dataset.seed, info.seed])
+
+
+class BatchPrefetcher:
+    """
+    Iterates a loader one batch ahead of the training step: batch N+1 is
+    taken from the loader (built by its workers in the meantime) and copied
+    to the device, on a side CUDA stream, while step N runs. wait_time holds
+    the seconds the current epoch spent blocked on the loader.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        self.wait_time = 0.0
+
+    def fetch(self, iterator):
+        start = time.perf_counter()
+        batch = next(iterator, None)
+        self.wait_time += time.perf_counter() - start
+        if batch is None:
+            return None
+        if self.stream is None:
+            return [t.to(self.device) for t in batch]
+        with torch.cuda.stream(self.stream):
+            return [t.to(self.device, non_blocking=True) for t in batch]
+
+    def __iter__(self):
+        self.wait_time = 0.0
+        iterator = iter(self.loader)
+        next_batch = self.fetch(iterator)
+        while next_batch is not None:
+            batch = next_batch
+            if self.stream is not None:
+                current = torch.cuda.current_stream(self.device)
+                current.wait_stream(self.stream)
+                for t in batch:
+                    t.record_stream(current)
+            next_batch = self.fetch(iterator)
+            yield batch
+
+    def __len__(self):
+        return len(self.loader)
+
 
 class SCDATA_sampler(Sampler):
-    def __init__(self, scdataset, batchsize, ptb_name=None):
-        self.intervindices = []
-        self.len = 0
+    """
+    Yields batches (arrays of dataset indices) that each contain a single
+    perturbation. If indices is given, ptb_name holds the perturbation of
+    each of those indices and only they are sampled.
+
+    The whole epoch's plan is built with array operations: indices are
+    shuffled within each perturbation, cut into full batches (leftovers are
+    dropped) and the batches are shuffled. Plans are drawn from a generator
+    keyed on (seed, epoch), or from numpy's global RNG if seed is None; the
+    epoch advances on every iteration unless set with set_epoch.
+
+    With groups_per_batch > 1, every batch concatenates groups_per_batch
+    such single-perturbation groups of batchsize indices (see
+    LossFunction.compute_loss with group_size); leftover groups are dropped.
+
+    With num_replicas > 1, every rank gets a disjoint shard of each epoch's
+    plan, truncated so that all ranks get the same number of batches.
+    """
+
+    def __init__(
+        self,
+        scdataset,
+        batchsize,
+        ptb_name=None,
+        indices=None,
+        seed=None,
+        num_replicas=1,
+        rank=0,
+        groups_per_batch=1,
+    ):
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"Invalid rank {rank} for {num_replicas} replicas")
         if ptb_name is None:
             ptb_name = scdataset.ptb_names
-        for ptb in set(ptb_name):
-            idx = np.where(ptb_name == ptb)[0]
-            self.intervindices.append(idx)
-            self.len += len(idx) // batchsize
+        if indices is None:
+            indices = np.arange(len(ptb_name))
+
+        # indices grouped by perturbation, in the order of the sorted names
+        _, groups = np.unique(np.asarray(ptb_name), return_inverse=True)
+        order = np.argsort(groups, kind="stable")
+        self.indices = np.asarray(indices, dtype=np.int64)[order]
+        self.groups = groups[order]
+        counts = np.bincount(self.groups)
+        self.group_start = np.cumsum(counts) - counts
+        self.group_batches = counts // batchsize
+
         self.batchsize = batchsize
+        self.groups_per_batch = groups_per_batch
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.len = int(self.group_batches.sum()) // groups_per_batch // num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def state_dict(self):
+        return {"epoch": self.epoch}
+
+    def load_state_dict(self, state):
+        self.epoch = state["epoch"]
+
+    def epoch_plan(self):
+        """(len(self), groups_per_batch * batchsize) array of dataset indices for the next epoch."""
+        if self.seed is None:
+            rng = np.random
+        else:
+            rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
 
-    def __iter__(self):
-        comb = []
-        for indices in self.intervindices:
-            random.shuffle(indices)
-            interv_batches = self.chunk(indices, self.batchsize)
-            if interv_batches:
-                comb += interv_batches
+        # shuffle within each perturbation, keeping the groups contiguous
+        order = np.lexsort((rng.random(len(self.indices)), self.groups))
+        pos = np.arange(len(order)) - self.group_start[self.groups]
+        keep = pos < self.group_batches[self.groups] * self.batchsize
+        batches = self.indices[order][keep].reshape(-1, self.batchsize)
 
-        combined = [batch.tolist() for batch in comb]
-        random.shuffle(combined)
-        return iter(combined)
+        batches = batches[rng.permutation(len(batches))]
+        n_groups = len(batches) // self.groups_per_batch * self.groups_per_batch
+        batches = batches[:n_groups].reshape(-1, self.groups_per_batch * self.batchsize)
+        return batches[: self.len * self.num_replicas][self.rank :: self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.epoch_plan())
 
     def __len__(self):
         return self.len
 
-    @staticmethod
-    def chunk(indices, chunk_size):
-        split = torch.split(torch.tensor(indices), chunk_size)
-        if len(indices) % chunk_size == 0:
-            return split
-        elif len(split) > 0:
-            return split[:-1]
+
+class StreamingSCDataset(IterableDataset):
+    """
+    Streams single-perturbation batches of an SCDataset whose X is read from
+    disk (a BackedRows view), with memory bounded independently of the
+    dataset size.
+
+    Each epoch, the cells of every perturbation (restricted to indices if
+    given) are cut into chunks of up to chunk_size cells in file order, and
+    the chunks are read one at a time, in shuffled order, with a single
+    sequential read each. Read cells wait in a shuffle buffer of about
+    buffer_size cells, from which batches of batchsize cells of one
+    perturbation are drawn at random; the leftover cells of a perturbation
+    that do not fill a batch are dropped, as in SCDATA_sampler. Control cells
+    are drawn per batch from a reservoir of about buffer_size // 4 controls,
+    reloaded from disk whenever it has been used up once (ctrl_pairing of
+    the dataset is therefore ignored).
+
+    Per-perturbation leftovers can hold the buffer above buffer_size by at
+    most one batch per perturbation. The buffer is run on indices first, so
+    the batches of an epoch are planned before any cell is read.
+
+    With groups_per_batch > 1, consecutive batches are concatenated by
+    groups_per_batch, as in SCDATA_sampler. With DataLoader workers, every
+    worker plans the same (grouped) batches and reads only the cells of
+    every num_workers-th one, so no cells are dropped and the length is
+    the same for any number of workers.
+    """
+
+    def __init__(
+        self,
+        scdataset,
+        batchsize,
+        indices=None,
+        chunk_size=1024,
+        buffer_size=16384,
+        seed=None,
+        groups_per_batch=1,
+    ):
+        super().__init__()
+        self.dataset = scdataset
+        self.batchsize = batchsize
+        self.groups_per_batch = groups_per_batch
+        self.chunk_size = max(chunk_size, batchsize)
+        self.buffer_size = max(buffer_size, self.chunk_size)
+        self.seed = np.random.randint(2**31 - 1) if seed is None else seed
+        self.epoch = 0
+
+        indices = np.arange(len(scdataset)) if indices is None else np.asarray(indices)
+        _, groups = np.unique(scdataset.ptb_names[indices], return_inverse=True)
+        order = np.lexsort((indices, groups))
+        self.group_indices = np.split(
+            indices[order], np.cumsum(np.bincount(groups))[:-1]
+        )
+        self.len = sum(len(idx) // batchsize for idx in self.group_indices) // groups_per_batch
+
+    def resample_ctrl_pairing(self):
+        """Controls are drawn per batch from the reservoir; nothing to resample."""
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch}
+
+    def load_state_dict(self, state):
+        self.seed, self.epoch = state["seed"], state["epoch"]
+
+    def plan_chunks(self, rng):
+        """(perturbation, sorted dataset indices) chunks in reading order."""
+        chunks = []
+        for group, idx in enumerate(self.group_indices):
+            # a random first cut varies the chunk boundaries across epochs
+            cuts = np.arange(rng.integers(self.chunk_size), len(idx), self.chunk_size)
+            chunks += [(group, chunk) for chunk in np.split(idx, cuts[cuts > 0])]
+        return [chunks[i] for i in rng.permutation(len(chunks))]
+
+    def plan_batches(self, chunks, rng):
+        """
+        Runs the shuffle buffer over the chunks on indices only: the
+        (dataset indices, chunk of every cell, chunk after whose read it is
+        drawn) of the epoch's batches, in drawing order.
+        """
+        buffers = defaultdict(list)  # perturbation -> [(dataset indices, chunks)]
+        counts = defaultdict(int)
+        buffered = 0
+        batches = []
+
+        def pop_batch(ready_at):
+            nonlocal buffered
+            ready = [g for g, n in counts.items() if n >= self.batchsize]
+            group = ready[rng.integers(len(ready))]
+            idx = np.concatenate([i for i, _ in buffers[group]])
+            src = np.concatenate([c for _, c in buffers[group]])
+            take = np.zeros(len(idx), dtype=bool)
+            take[rng.choice(len(idx), self.batchsize, replace=False)] = True
+            buffers[group] = [(idx[~take], src[~take])]
+            counts[group] -= self.batchsize
+            buffered -= self.batchsize
+            batches.append((idx[take], src[take], ready_at))
+
+        def has_ready():
+            return any(n >= self.batchsize for n in counts.values())
+
+        for pos, (group, idx) in enumerate(chunks):
+            buffers[group].append((idx, np.full(len(idx), pos)))
+            counts[group] += len(idx)
+            buffered += len(idx)
+            while buffered > self.buffer_size and has_ready():
+                pop_batch(pos)
+
+        while has_ready():
+            pop_batch(len(chunks) - 1)
+        return batches
+
+    def __iter__(self):
+        # worker copies of the dataset also key the epoch's plan on the base seed
+        # that the DataLoader draws for fresh workers, since their epoch count
+        # starts over with every copy (persistent workers keep counting)
+        worker = get_worker_info()
+        if worker is None:
+            key = [self.seed, self.epoch]
+            worker_id, num_workers = 0, 1
         else:
-            return []
+            key = [self.seed, worker.seed - worker.id, self.epoch]
+            worker_id, num_workers = worker.id, worker.num_workers
+        self.epoch += 1
+        rng = np.random.default_rng(key)
+        chunks = self.plan_chunks(rng)
+        batches = self.plan_batches(chunks, rng)
+
+        # every worker plans the same steps and yields every num_workers-th one,
+        # so the DataLoader returns them in plan order
+        G = self.groups_per_batch
+        steps = [batches[i : i + G] for i in range(0, len(batches) - G + 1, G)]
+        steps = steps[worker_id::num_workers]
+
+        for step in self.read_steps(chunks, steps, np.random.default_rng(key + [worker_id + 1])):
+            if G == 1:
+                yield step[0]
+            else:
+                yield tuple(torch.cat(t) for t in zip(*step))
+
+    def read_steps(self, chunks, steps, rng):
+        """
+        Reads the cells of steps (lists of planned batches) with one read per
+        chunk and yields the batches of each step once its last chunk is read.
+        Controls are drawn with rng.
+        """
+        dataset = self.dataset
+        ctrl_size = min(len(dataset.ctrl_rows), max(self.buffer_size // 4, self.batchsize))
+        ctrl_pool, ctrl_uses = None, ctrl_size
+
+        if not steps:
+            return
+        # cells used by the steps, sorted by chunk and index
+        idx = np.concatenate([b[0] for step in steps for b in step])
+        src = np.concatenate([b[1] for step in steps for b in step])
+        order = np.lexsort((idx, src))
+        idx, src = idx[order], src[order]
+        bounds = np.searchsorted(src, np.arange(len(chunks) + 1))
+
+        loaded = {}  # chunk -> [sorted dataset indices, CSR rows, cells left]
+
+        def read_batch(idx, src):
+            nonlocal ctrl_pool, ctrl_uses
+            order = np.argsort(src, kind="stable")
+            idx, src = idx[order], src[order]
+            positions, starts = np.unique(src, return_index=True)
+            rows = []
+            for pos, cells in zip(positions, np.split(idx, starts[1:])):
+                chunk_idx, chunk_rows, _ = loaded[pos]
+                rows.append(chunk_rows[np.searchsorted(chunk_idx, cells)])
+                loaded[pos][2] -= len(cells)
+                if loaded[pos][2] == 0:
+                    del loaded[pos]
+
+            if ctrl_uses >= ctrl_size:
+                ctrl_rows = np.sort(rng.choice(dataset.ctrl_rows, ctrl_size, replace=False))
+                ctrl_pool, ctrl_uses = dataset.X[ctrl_rows], 0
+            ctrl_uses += self.batchsize
+
+            x = ctrl_pool[rng.integers(ctrl_size, size=self.batchsize)].toarray()
+            y = sp.vstack(rows, format="csr").toarray()
+            return (
+                torch.from_numpy(x).to(dataset.dtype),
+                torch.from_numpy(y).to(dataset.dtype),
+                dataset.interventions(dataset.ptb_codes[idx]),
+            )
+
+        step = 0
+        for pos in range(len(chunks)):
+            chunk_idx = idx[bounds[pos] : bounds[pos + 1]]
+            if len(chunk_idx):
+                loaded[pos] = [chunk_idx, dataset.X[dataset.ptb_rows[chunk_idx]], len(chunk_idx)]
+            while step < len(steps) and steps[step][-1][2] <= pos:
+                yield [read_batch(b_idx, b_src) for b_idx, b_src, _ in steps[step]]
+                step += 1
+
+    def __len__(self):
+        return self.len
 
 
 """MMD LOSS"""
@@ -383,30 +1320,45 @@ class MMD_loss(nn.Module):
     def gaussian_kernel(
         self, source, target, kernel_mul=2.0, kernel_num=5, fix_sigma=None
     ):
-        n_samples = int(source.size()[0]) + int(target.size()[0])
-        total = torch.cat([source, target], dim=0)
-
-        total0 = total.unsqueeze(0).expand(
-            int(total.size(0)), int(total.size(0)), int(total.size(1))
-        )
-        total1 = total.unsqueeze(1).expand(
-            int(total.size(0)), int(total.size(0)), int(total.size(1))
-        )
-        L2_distance = ((total0 - total1) ** 2).sum(2)
+        """
+        Sum of Gaussian kernels with kernel_num bandwidths between all rows of
+        source and target stacked. Squared distances are expanded as
+        ||a||^2 + ||b||^2 - 2 a.b (O(n^2) memory instead of O(n^2 d)) and all
+        bandwidths are evaluated in one broadcast exp.
+
+        source and target may have leading batch dimensions (e.g. (G, n, d)
+        for G groups), in which case the kernels (G, 2n, 2n) of all groups are
+        computed in one call, each with its own bandwidth if fix_sigma is unset.
+        """
+        n_samples = int(source.size()[-2]) + int(target.size()[-2])
+        total = torch.cat([source, target], dim=-2)
+        # distances are shift-invariant; centering limits cancellation in the expansion
+        total = total - total.mean(dim=-2, keepdim=True).detach()
+
+        sq_norms = total.pow(2).sum(dim=-1)
+        L2_distance = (
+            sq_norms.unsqueeze(-1)
+            + sq_norms.unsqueeze(-2)
+            - 2 * (total @ total.transpose(-2, -1))
+        ).clamp(min=0)
         if fix_sigma:
             bandwidth = fix_sigma
         else:
-            bandwidth = torch.sum(L2_distance.data) / (n_samples**2 - n_samples)
-        bandwidth /= kernel_mul ** (kernel_num // 2)
-        bandwidth_list = [bandwidth * (kernel_mul**i) for i in range(kernel_num)]
-        kernel_val = [
-            torch.exp(-L2_distance / bandwidth_temp)
-            for bandwidth_temp in bandwidth_list
-        ]
-        return sum(kernel_val)
+            # one bandwidth per group, broadcast over the kernel_num bandwidths
+            bandwidth = torch.sum(
+                L2_distance.detach(), dim=(-2, -1), keepdim=True
+            ).unsqueeze(-3) / (n_samples**2 - n_samples)
+        bandwidths = bandwidth * mmd_bandwidths(
+            1.0, kernel_mul, kernel_num, total.dtype, total.device
+        ).view(-1, 1, 1)
+        return torch.exp(-L2_distance.unsqueeze(-3) / bandwidths).sum(dim=-3)
 
     def forward(self, source, target):
-        batch_size = int(source.size()[0])
+        """
+        MMD between source and target. With (G, n, d) inputs, the mean of the
+        MMDs of the G groups, computed in one call.
+        """
+        batch_size = int(source.size()[-2])
         kernels = self.gaussian_kernel(
             source,
             target,
@@ -414,16 +1366,171 @@ class MMD_loss(nn.Module):
             kernel_num=self.kernel_num,
             fix_sigma=self.fix_sigma,
         )
-        XX = kernels[:batch_size, :batch_size]
-        YY = kernels[batch_size:, batch_size:]
-        XY = kernels[:batch_size, batch_size:]
-        YX = kernels[batch_size:, :batch_size]
+        XX = kernels[..., :batch_size, :batch_size]
+        YY = kernels[..., batch_size:, batch_size:]
+        XY = kernels[..., :batch_size, batch_size:]
+        YX = kernels[..., batch_size:, :batch_size]
         loss = torch.mean(XX + YY - XY - YX)
         return loss
 
+    def blockwise(self, source, target, block_size=1024):
+        """
+        Same estimate as forward, accumulated from kernel sums over
+        block_size x block_size tiles, so memory stays bounded for populations
+        of any size. source and target may differ in size.
+        """
+        total = torch.cat([source, target], dim=0)
+        total = total - total.mean(dim=0, keepdim=True)
+        sq_norms = total.pow(2).sum(dim=1)
+        n_samples = total.shape[0]
+        if self.fix_sigma:
+            bandwidth = self.fix_sigma
+        else:
+            # sum of all pairwise squared distances of centered rows is 2n * sum ||a_i||^2
+            bandwidth = 2 * n_samples * sq_norms.sum() / (n_samples**2 - n_samples)
+        bandwidths = mmd_bandwidths(
+            bandwidth, self.kernel_mul, self.kernel_num, total.dtype, total.device
+        ).view(-1, 1, 1)
+
+        def kernel_sum(a, a_sq, b, b_sq):
+            out = total.new_zeros(())
+            for i in range(0, a.shape[0], block_size):
+                for j in range(0, b.shape[0], block_size):
+                    L2_distance = (
+                        a_sq[i : i + block_size, None]
+                        + b_sq[None, j : j + block_size]
+                        - 2 * (a[i : i + block_size] @ b[j : j + block_size].T)
+                    ).clamp(min=0)
+                    out += torch.exp(-L2_distance / bandwidths).sum()
+            return out
+
+        n_source = source.shape[0]
+        s, s_sq = total[:n_source], sq_norms[:n_source]
+        t, t_sq = total[n_source:], sq_norms[n_source:]
+        n_target = t.shape[0]
+        return (
+            kernel_sum(s, s_sq, s, s_sq) / n_source**2
+            + kernel_sum(t, t_sq, t, t_sq) / n_target**2
+            - 2 * kernel_sum(s, s_sq, t, t_sq) / (n_source * n_target)
+        )
+
+def mmd_bandwidths(sigma, kernel_mul, kernel_num, dtype=None, device=None):
+    """The kernel_num bandwidths of the multi-bandwidth kernel of MMD_loss, centered on sigma."""
+    exponents = torch.arange(kernel_num, dtype=dtype, device=device)
+    return sigma * kernel_mul ** (exponents - kernel_num // 2)
+
+
+class LinearMMD:
+    """
+    Linear-time MMD estimate (Gretton et al., 2012) with the multi-bandwidth
+    Gaussian kernel of MMD_loss: consecutive rows of source and target are
+    paired, and the estimate is the mean over pairs of
+    k(x1, x2) + k(y1, y2) - k(x1, y2) - k(x2, y1). Unlike MMD_loss (a biased
+    V-statistic) it is unbiased, so both agree up to O(1/n).
+
+    statistics() returns additive sufficient statistics, so an estimate over a
+    whole population can be accumulated batch by batch and read with
+    finalize(). The bandwidth must be fixed (fix_sigma).
+    """
+
+    def __init__(self, kernel_mul=2.0, kernel_num=5, fix_sigma=None):
+        if not fix_sigma:
+            raise ValueError("LinearMMD requires a fixed bandwidth (fix_sigma)")
+        self.kernel_mul = kernel_mul
+        self.kernel_num = kernel_num
+        self.fix_sigma = fix_sigma
+
+    def kernel(self, a, b):
+        """Kernel between matching rows of a and b."""
+        bandwidths = mmd_bandwidths(
+            self.fix_sigma, self.kernel_mul, self.kernel_num, a.dtype, a.device
+        )
+        L2_distance = (a - b).pow(2).sum(dim=1, keepdim=True)
+        return torch.exp(-L2_distance / bandwidths).sum(dim=1)
+
+    def statistics(self, source, target):
+        m = min(len(source), len(target)) // 2
+        x1, x2 = source[: 2 * m : 2], source[1 : 2 * m : 2]
+        y1, y2 = target[: 2 * m : 2], target[1 : 2 * m : 2]
+        h = self.kernel(x1, x2) + self.kernel(y1, y2) - self.kernel(x1, y2) - self.kernel(x2, y1)
+        return torch.stack([h.sum(), torch.tensor(m, dtype=h.dtype, device=h.device)])
+
+    def finalize(self, stats):
+        return stats[0] / stats[1]
+
+    def __call__(self, source, target):
+        return self.finalize(self.statistics(source, target))
+
+
+class RandomFourierMMD:
+    """
+    MMD with a random Fourier feature approximation of the multi-bandwidth
+    Gaussian kernel of MMD_loss: each bandwidth contributes num_features
+    features sqrt(2 / num_features) * cos(x W + b), with W drawn from the
+    kernel's spectral density. The squared distance between the mean features
+    of source and target approximates the estimate of MMD_loss.
+
+    statistics() returns additive sufficient statistics (feature sums and
+    counts), so an estimate over a whole population can be accumulated batch
+    by batch in O(n) and read with finalize().
+    """
+
+    def __init__(
+        self,
+        dim,
+        kernel_mul=2.0,
+        kernel_num=5,
+        fix_sigma=None,
+        num_features=1024,
+        seed=0,
+        dtype=torch.float64,
+        device="cpu",
+    ):
+        if not fix_sigma:
+            raise ValueError("RandomFourierMMD requires a fixed bandwidth (fix_sigma)")
+        generator = torch.Generator().manual_seed(seed)
+        bandwidths = mmd_bandwidths(fix_sigma, kernel_mul, kernel_num, torch.float64)
+
+        # exp(-||d||^2 / bw) has spectral density N(0, 2 / bw)
+        W = torch.randn(kernel_num, dim, num_features, generator=generator, dtype=torch.float64)
+        W = W * torch.sqrt(2 / bandwidths).view(-1, 1, 1)
+        self.W = W.permute(1, 0, 2).reshape(dim, -1).to(device=device, dtype=dtype)
+        self.b = (
+            torch.rand(kernel_num * num_features, generator=generator, dtype=torch.float64)
+            * 2
+            * math.pi
+        ).to(device=device, dtype=dtype)
+        self.scale = math.sqrt(2 / num_features)
+
+    def features(self, x):
+        return self.scale * torch.cos(x.to(self.W.dtype) @ self.W + self.b)
+
+    def statistics(self, source, target):
+        counts = torch.tensor(
+            [len(source), len(target)], dtype=self.W.dtype, device=self.W.device
+        )
+        return torch.cat(
+            [self.features(source).sum(dim=0), self.features(target).sum(dim=0), counts]
+        )
+
+    def finalize(self, stats):
+        n_source, n_target = stats[-2], stats[-1]
+        source_sum, target_sum = stats[:-2].chunk(2)
+        return (source_sum / n_source - target_sum / n_target).pow(2).sum()
+
+    def __call__(self, source, target):
+        return self.finalize(self.statistics(source, target))
+
+
 # Assuming MMD_loss is defined elsewhere
 class LossFunction:
-    def __init__(self, MMD_sigma: float, kernel_num: int, matched_IO: bool = False):
+    def __init__(
+        self,
+        MMD_sigma: float,
+        kernel_num: int,
+        matched_IO: bool = False,
+        dtype: Optional[torch.dtype] = None,
+    ):
         """
         Initializes the LossFunction class with required parameters.
 
@@ -431,10 +1538,12 @@ class LossFunction:
             MMD_sigma (float): Sigma value for MMD kernel.
             kernel_num (int): Number of kernels for MMD.
             matched_IO (bool): Whether matched input/output pairs are used.
+            dtype (torch.dtype): If set, inputs are cast to this dtype before computing the losses.
         """
         self.MMD_sigma = MMD_sigma
         self.kernel_num = kernel_num
         self.matched_IO = matched_IO
+        self.dtype = dtype
         self.mse_loss_fn = nn.MSELoss()
 
     def compute_loss(
@@ -446,10 +1555,17 @@ class LossFunction:
         mu: torch.Tensor,
         var: torch.Tensor,
         G: Optional[torch.Tensor],
+        group_size: Optional[int] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         """
         Computes the losses: MMD, MSE, KL-divergence, and L1 regularization.
 
+        If group_size is set, the batch is made of consecutive groups of
+        group_size rows that each hold one perturbation (see groups_per_batch
+        of SCDATA_sampler). The losses are then the means over groups of the
+        losses of each group on its own: MMD is computed per group in one
+        batched kernel evaluation, and KLD is normalized by the group size.
+
         Args:
             y_hat (torch.Tensor): Predicted output.
             y (torch.Tensor): True output.
@@ -458,10 +1574,18 @@ class LossFunction:
             mu (torch.Tensor): Latent mean.
             var (torch.Tensor): Latent variance.
             G (torch.Tensor): Optional adjacency matrix for graph regularization.
+            group_size (int): Number of rows of each single-perturbation group.
 
         Returns:
             Tuple: MMD loss, MSE loss, KL-divergence, L1 loss.
         """
+        # Compute the losses in the requested precision (e.g. float32 under bf16 autocast)
+        if self.dtype is not None:
+            y_hat, y, x_recon, x, mu, var = (
+                t if t is None else t.to(self.dtype)
+                for t in (y_hat, y, x_recon, x, mu, var)
+            )
+
         # Choose the appropriate matching function based on matched_IO
         matching_function_interv = (
             MMD_loss(fix_sigma=self.MMD_sigma, kernel_num=self.kernel_num)
@@ -472,7 +1596,10 @@ class LossFunction:
         # Reconstruction loss using MSE
         matching_function_recon = self.mse_loss_fn
 
-        # MMD loss (or MSE if matched_IO is True)
+        # MMD loss (or MSE if matched_IO is True), segmented by perturbation group
+        if y_hat is not None and group_size is not None:
+            y_hat = y_hat.reshape(-1, group_size, y_hat.shape[-1])
+            y = y.reshape(-1, group_size, y.shape[-1])
         MMD = 0 if y_hat is None else matching_function_interv(y_hat, y)
         
         # Mean Squared Error (MSE) loss
@@ -481,7 +1608,7 @@ class LossFunction:
         # KL-Divergence (KLD) loss
         logvar = torch.log(var)
         KLD_element = mu.pow(2).add_(logvar.exp()).mul_(-1).add_(1).add_(logvar)
-        KLD = torch.mean(KLD_element).mul_(-0.5) / x.shape[0]
+        KLD = torch.mean(KLD_element).mul_(-0.5) / (group_size or x.shape[0])
 
         # L1 Regularization (only if adjacency matrix G is provided)
         L1 = (
@@ -0,0 +1,76 @@
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "sena_discrepancy_vae"))
+
+from artifact import load_model_artifact, save_model_artifact  # noqa: E402
+from inference import load_model  # noqa: E402
+from model import CMVAE  # noqa: E402
+
+DEVICES = ["meta"] + (["cuda"] if torch.cuda.is_available() else [])
+
+MODEL_KWARGS = {
+    "mlp": dict(mode="mlp"),
+    "sena": dict(mode="sena", sena_lambda=0.1),
+    "sena_sparse": dict(mode="sena", sena_lambda=0, sena_sparse=True),
+}
+
+
+def build_model(kwargs):
+    rel_dict = {0: [0], 1: [0, 2], 3: [1], 5: [2]}
+    return CMVAE(dim=6, z_dim=4, c_dim=3, gos=range(3), rel_dict=rel_dict, **kwargs)
+
+
+@pytest.mark.parametrize("name", list(MODEL_KWARGS))
+def test_round_trip_on_cpu(tmp_path, name):
+    model = build_model(MODEL_KWARGS[name])
+    save_model_artifact(model, str(tmp_path))
+    loaded = load_model_artifact(str(tmp_path))
+
+    state, loaded_state = model.state_dict(), loaded.state_dict()
+    assert state.keys() == loaded_state.keys()
+    for key, tensor in state.items():
+        assert torch.equal(tensor, loaded_state[key]), key
+
+
+@pytest.mark.parametrize("device", DEVICES)
+@pytest.mark.parametrize("name", list(MODEL_KWARGS))
+def test_load_on_device(tmp_path, name, device):
+    save_model_artifact(build_model(MODEL_KWARGS[name]), str(tmp_path))
+    model = load_model_artifact(str(tmp_path), device=device)
+
+    for key, tensor in [*model.named_parameters(), *model.named_buffers()]:
+        assert tensor.device.type == device, key
+    if getattr(model.fc1, "mask", None) is not None:
+        assert model.fc1.mask.device.type == device
+
+
+@pytest.mark.parametrize("name", list(MODEL_KWARGS))
+def test_loaded_model_matches(tmp_path, name):
+    model = build_model(MODEL_KWARGS[name])
+    save_model_artifact(model, str(tmp_path))
+    loaded = load_model_artifact(str(tmp_path))
+
+    for key, tensor in [*loaded.named_parameters(), *loaded.named_buffers()]:
+        assert tensor.device.type == "cpu", key
+    if getattr(model.fc1, "mask", None) is not None:
+        assert torch.equal(loaded.fc1.mask, model.fc1.mask)
+
+    x, c = torch.rand(5, 6), torch.eye(3)[[0, 1, 2, 0, 1]]
+    torch.manual_seed(0)
+    expected = model(x, c, c)[0]
+    torch.manual_seed(0)
+    assert torch.allclose(loaded(x, c, c)[0], expected)
+
+
+def test_load_pickled_model(tmp_path):
+    model = build_model(MODEL_KWARGS["sena"])
+    torch.save(model, os.path.join(tmp_path, "best_model.pt"))
+    loaded = load_model(str(tmp_path))
+
+    assert isinstance(loaded, CMVAE)
+    for key, tensor in model.state_dict().items():
+        assert torch.equal(tensor, loaded.state_dict()[key]), key
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "sena_discrepancy_vae"))
+
+from model import CMVAE  # noqa: E402
+
+C_DIM = 4
+
+
+def build_model():
+    torch.manual_seed(0)
+    return CMVAE(dim=6, z_dim=3, c_dim=C_DIM, gos=range(5)).double()
+
+
+def run(model, x, c, c2, num_interv):
+    torch.manual_seed(1)
+    return model(x, c, c2, num_interv=num_interv)[0]
+
+
+def onehot(c):
+    return F.one_hot(c[:, 0], C_DIM).double()
+
+
+def test_index_interventions_follow_num_interv():
+    model = build_model()
+    x = torch.rand(2, 6, dtype=torch.float64)
+    c = torch.tensor([[0], [1]])
+    c2 = torch.tensor([[2], [3]])
+
+    # a second intervention is only applied with num_interv=2, whatever the object identity
+    single = run(model, x, c, c, 1)
+    assert torch.allclose(run(model, x, c, c.clone(), 1), single)
+    assert torch.allclose(run(model, x, c, c2, 1), single)
+    assert torch.allclose(run(model, x, onehot(c), onehot(c), 1), single)
+
+    double = run(model, x, c, c2, 2)
+    assert torch.allclose(double, run(model, x, onehot(c), onehot(c2), 2))
+    assert not torch.allclose(double, single)
+
+    # as for float encodings, num_interv=2 with c2 equal to c applies c twice
+    twice = onehot(c)
+    assert torch.allclose(run(model, x, c, c, 2), run(model, x, twice, twice, 2))
+    assert torch.allclose(run(model, x, c, c.clone(), 2), run(model, x, c, c, 2))
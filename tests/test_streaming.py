@@ -0,0 +1,54 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "sena_discrepancy_vae"))
+
+from utils import SCDataset, StreamingSCDataset  # noqa: E402
+
+
+def make_dataset(num_targets=4, cells_per_target=40, num_ctrl=30, num_genes=8):
+    rng = np.random.default_rng(0)
+    n = num_targets * cells_per_target + num_ctrl
+    X = sp.csr_matrix(rng.random((n, num_genes)))
+    codes = np.full((n, 2), -1)
+    codes[: num_targets * cells_per_target, 0] = np.repeat(np.arange(num_targets), cells_per_target)
+    targets = [f"g{i}" for i in range(num_targets)]
+    guide_ids = np.array([targets[c] if c >= 0 else "" for c in codes[:, 0]], dtype=object)
+    return SCDataset(X, codes, pd.Categorical(guide_ids), targets, seed=0)
+
+
+def epoch_sums(loader, epochs):
+    return [torch.stack([y.sum() for _, y, _ in loader]) for _ in range(epochs)]
+
+
+@pytest.mark.parametrize(
+    "loader_kwargs",
+    [
+        dict(num_workers=0),
+        dict(num_workers=2),
+        dict(num_workers=2, persistent_workers=True),
+    ],
+)
+def test_epochs_are_reshuffled(loader_kwargs):
+    stream = StreamingSCDataset(make_dataset(), 8, chunk_size=16, buffer_size=32, seed=0)
+    loader = DataLoader(stream, batch_size=None, **loader_kwargs)
+
+    sums = epoch_sums(loader, 2)
+    assert len(sums[0]) == len(sums[1]) == len(stream)
+    assert not torch.equal(sums[0], sums[1])
+    # every cell is used exactly once per epoch
+    assert torch.allclose(sums[0].sum(), sums[1].sum())
+
+
+def test_workers_drop_no_batches():
+    stream = StreamingSCDataset(make_dataset(), 8, chunk_size=16, buffer_size=32, seed=0, groups_per_batch=2)
+    for num_workers in (0, 2, 3):
+        loader = DataLoader(stream, batch_size=None, num_workers=num_workers)
+        assert sum(1 for _ in loader) == len(stream)